@@ -0,0 +1,376 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import logging
+import platform
+import subprocess
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from copy_missing import load_missing_list
+from metrics import REPORT_DIR
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+
+# Fase → (script, risposte ai prompt su stdin)
+STAGES = {
+    "extract_media": ("extract_media.py", ""),
+    "cache_cold": ("cache_builder.py", ""),
+    "cache_warm": ("cache_builder.py", ""),
+    "find_missing": ("find_missing.py", "2\ns\ns\n"),
+    "copy_missing": ("copy_missing.py", ""),
+    "remove_duplicates": ("remove_duplicates.py", ""),
+    "organise": ("organise.py", ""),
+}
+
+# Pacchetti senza i quali una fase viene saltata
+REQUIREMENTS = {"organise": ("torch", "clip", "face_recognition")}
+
+# Blocco di byte casuali da cui si ritagliano i contenuti dei file sintetici
+POOL_SIZE = 8 * 1024 * 1024
+# Byte iniziali unici per file: contenuti (e hash parziali) diversi anche se il resto viene dal blocco comune
+HEADER_SIZE = 64
+
+PHOTO_EXT = ".jpg"
+VIDEO_EXT = ".mp4"
+
+def setup_logger():
+    logs_dir = Path("logs")
+    logs_dir.mkdir(exist_ok=True)
+    log_path = logs_dir / "benchmark.log"
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[
+            logging.FileHandler(log_path, encoding='utf-8'),
+            logging.StreamHandler()
+        ]
+    )
+
+def load_config():
+    with open("config.json", "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def tree_spec(bench_cfg: dict) -> dict:
+    """Parametri che determinano l'albero generato (le fasi da eseguire non ne fanno parte)."""
+    spec = {k: v for k, v in bench_cfg.items() if k not in ("root", "results_dir", "stages")}
+    spec["jpeg"] = Image is not None
+    return spec
+
+def folders(base: Path, depth: int, per_level: int) -> list:
+    """Tutte le cartelle fino a ``depth`` livelli sotto ``base``, radice compresa."""
+    level = [base]
+    found = [base]
+    for _ in range(depth):
+        level = [parent / f"album_{i}" for parent in level for i in range(per_level)]
+        found.extend(level)
+    return found
+
+def file_size(rnd: random.Random, dist: dict) -> int:
+    """Dimensione in byte da una lognormale con mediana ``median`` KB, limitata a [min, max]."""
+    kb = rnd.lognormvariate(math.log(dist["median"]), dist.get("sigma", 1.0))
+    return int(min(max(kb, dist["min"]), dist["max"]) * 1024)
+
+def write_bytes(path: Path, size: int, rnd: random.Random, pool: memoryview):
+    with open(path, "wb") as f:
+        header = rnd.randbytes(min(size, HEADER_SIZE))
+        f.write(header)
+        remaining = size - len(header)
+        half = len(pool) // 2
+        while remaining > 0:
+            start = rnd.randrange(half)
+            chunk = pool[start:start + min(remaining, half)]
+            f.write(chunk)
+            remaining -= len(chunk)
+
+def write_jpeg(path: Path, size: int, rnd: random.Random):
+    """JPEG vero (rumore, 4:3) di circa ``size`` byte: organise deve poterlo decodificare."""
+    pixels = max(64 * 48, size // 2)
+    width = int(math.sqrt(pixels * 4 / 3))
+    height = width * 3 // 4
+    Image.frombytes("RGB", (width, height), rnd.randbytes(width * height * 3)).save(path, "JPEG", quality=90)
+
+def write_media(path: Path, media: str, size: int, rnd: random.Random, pool: memoryview):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if media == "foto" and Image is not None:
+        write_jpeg(path, size, rnd)
+    else:
+        write_bytes(path, size, rnd, pool)
+
+def copy_to(src: Path, dest: Path):
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(src, dest)
+
+def generate_tree(root: Path, spec: dict):
+    """Genera in modo deterministico la sorgente iniziale e le sorgenti secondarie.
+
+    - ``sorgente``: ``files`` file annidati fino a ``depth`` livelli, di cui una quota
+      ``duplicate_ratio`` sono copie byte per byte (con un altro nome) di file precedenti;
+    - ``altre_foto``/``altro_video``: copie di una quota ``known_ratio`` dei file della
+      sorgente (``renamed_ratio`` di queste con un nome diverso, per il fallback sull'hash)
+      più ``missing_ratio`` × ``files`` file nuovi, che find_missing deve segnalare.
+
+    La disposizione dipende solo da ``seed``; il contenuto di ogni file da ``seed`` e dal
+    suo numero, così due alberi con gli stessi parametri sono identici.
+    """
+    seed = spec["seed"]
+    rnd = random.Random(seed)
+    pool = memoryview(random.Random(f"{seed}-pool").randbytes(POOL_SIZE))
+    depth, per_level = spec.get("depth", 3), spec.get("dirs_per_level", 3)
+    source_dirs = folders(root / "sorgente", depth, per_level)
+    secondary_dirs = {
+        "foto": folders(root / "altre_foto", depth, per_level),
+        "video": folders(root / "altro_video", depth, per_level),
+    }
+    originals = {"foto": [], "video": []}
+
+    def size_for(media):
+        return file_size(rnd, spec["photo_kb" if media == "foto" else "video_kb"])
+
+    def pick(n):
+        if rnd.random() < spec.get("video_ratio", 0.05):
+            return "video", f"VID_{n:06d}", VIDEO_EXT
+        return "foto", f"IMG_{n:06d}", PHOTO_EXT
+
+    for n in range(spec["files"]):
+        media, stem, ext = pick(n)
+        dest = rnd.choice(source_dirs) / f"{stem}{ext}"
+        if originals[media] and rnd.random() < spec.get("duplicate_ratio", 0.1):
+            copy_to(rnd.choice(originals[media]), dest)
+        else:
+            write_media(dest, media, size_for(media), random.Random(f"{seed}-{n}"), pool)
+            originals[media].append(dest)
+        if rnd.random() < spec.get("known_ratio", 0.5):
+            name = f"{stem}_copia{ext}" if rnd.random() < spec.get("renamed_ratio", 0.2) else dest.name
+            copy_to(dest, rnd.choice(secondary_dirs[media]) / name)
+
+    # File che mancano in output: finiscono nelle liste di copy_missing
+    missing = round(spec["files"] * spec.get("missing_ratio", 0.1))
+    for n in range(spec["files"], spec["files"] + missing):
+        media, stem, ext = pick(n)
+        write_media(rnd.choice(secondary_dirs[media]) / f"{stem}{ext}", media, size_for(media),
+                    random.Random(f"{seed}-{n}"), pool)
+
+def prepare_tree(root: Path, spec: dict):
+    """Riusa l'albero già generato con gli stessi parametri, altrimenti lo rigenera."""
+    spec_path = root / "spec.json"
+    if spec_path.exists() and json.loads(spec_path.read_text(encoding="utf-8")) == spec:
+        logging.info(f"♻️  Albero sintetico già presente in {root}")
+        return
+    if root.exists():
+        shutil.rmtree(root)
+    logging.info(f"🧪 Generazione albero sintetico in {root} ({spec['files']} file, seed {spec['seed']})")
+    start = time.perf_counter()
+    # In un processo a parte: su Linux il picco RSS dei figli parte da quello di chi li
+    # avvia, e la generazione farebbe crescere quello di questo processo
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        pool.submit(generate_tree, root, spec).result()
+    spec_path.write_text(json.dumps(spec, indent=2), encoding="utf-8")
+    logging.info(f"Albero generato in {time.perf_counter() - start:.1f}s")
+
+def write_bench_config(root: Path, config: dict):
+    """config.json dell'albero: quello del progetto con sorgenti, output e liste puntati all'albero."""
+    bench_config = {k: v for k, v in config.items() if k != "benchmark"}
+    bench_config["sources"] = {
+        "initial": str((root / "sorgente").resolve()),
+        "altre_foto": [str((root / "altre_foto").resolve())],
+        "altro_video": [str((root / "altro_video").resolve())],
+    }
+    bench_config["output"] = {"foto": "output/foto", "video": "output/video"}
+    bench_config["missing_lists"] = {"foto": "missing/missing_foto.txt", "video": "missing/missing_video.txt"}
+    (root / "config.json").write_text(json.dumps(bench_config, indent=2, ensure_ascii=False), encoding="utf-8")
+    return bench_config
+
+def reset_run(root: Path):
+    """Toglie i risultati dell'esecuzione precedente: ogni run parte da output e indice vuoti."""
+    for name in ("output", "cache", "missing", "logs", "log"):
+        shutil.rmtree(root / name, ignore_errors=True)
+    (root / "missing").mkdir()
+
+def measure(paths, exts) -> tuple:
+    """(numero di file, byte totali) con estensione in ``exts`` sotto ``paths``."""
+    count = total = 0
+    for base in paths:
+        for dirpath, _, filenames in os.walk(base):
+            for name in filenames:
+                if os.path.splitext(name)[1].lower() in exts:
+                    count += 1
+                    total += os.path.getsize(os.path.join(dirpath, name))
+    return count, total
+
+def stage_input(stage: str, root: Path, cfg: dict) -> tuple:
+    """Lavoro che la fase deve svolgere, misurato prima di eseguirla."""
+    photo_ext = {e.lower() for e in cfg["media"]["photo_extensions"]}
+    exts = photo_ext | {e.lower() for e in cfg["media"]["video_extensions"]}
+    outputs = [root / cfg["output"]["foto"], root / cfg["output"]["video"]]
+    if stage == "extract_media":
+        return measure([cfg["sources"]["initial"]], exts)
+    if stage == "find_missing":
+        return measure(cfg["sources"]["altre_foto"] + cfg["sources"]["altro_video"], exts)
+    if stage == "copy_missing":
+        entries = [entry for path in cfg["missing_lists"].values() if (root / path).exists()
+                   for entry in load_missing_list(root / path)]
+        return len(entries), sum(size for _, size, _ in entries)
+    if stage == "organise":
+        return measure(outputs[:1], photo_ext)
+    return measure(outputs, exts)
+
+def run_script(script: str, stdin_text: str, cwd: Path, log_path: Path) -> tuple:
+    """Esegue uno script in un processo figlio: (secondi, returncode, picco RSS in byte o None).
+
+    Il picco RSS viene da wait4 e copre il figlio e i suoi processi già terminati
+    (es. il pool dei volti di organise); su Windows non è disponibile. Su Linux non
+    scende sotto l'RSS di questo processo al momento dell'avvio.
+    """
+    env = dict(os.environ, PYTHONIOENCODING="utf-8")
+    start = time.perf_counter()
+    with open(log_path, "wb") as out:
+        proc = subprocess.Popen([sys.executable, str(SCRIPTS_DIR / script)], cwd=cwd, env=env,
+                                stdin=subprocess.PIPE, stdout=out, stderr=subprocess.STDOUT)
+        try:
+            proc.stdin.write(stdin_text.encode())
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        if hasattr(os, "wait4"):
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss è in KB su Linux, in byte su macOS
+            peak = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        else:
+            proc.wait()
+            peak = None
+    return time.perf_counter() - start, proc.returncode, peak
+
+def stage_metrics(report_path: Path) -> dict:
+    """Contatori, tassi di hit e tempi (senza bucket) dal report metrics dello script."""
+    if not report_path.exists():
+        return None
+    data = json.loads(report_path.read_text(encoding="utf-8"))
+    return {
+        "counters": data["counters"],
+        "hit_rates": data["hit_rates"],
+        "timers": {name: {k: h[k] for k in ("count", "sum", "mean", "max")}
+                   for name, h in data["histograms"].items()},
+    }
+
+def missing_requirements(stage: str) -> list:
+    return [name for name in REQUIREMENTS.get(stage, ()) if importlib.util.find_spec(name) is None]
+
+def run_stage(stage: str, root: Path, cfg: dict) -> dict:
+    missing = missing_requirements(stage)
+    if missing:
+        logging.warning(f"⏭️  {stage} saltata: mancano {', '.join(missing)}")
+        return {"status": "skipped", "missing": missing}
+    if stage == "cache_cold":
+        for path in (root / "cache").glob("index.sqlite*"):
+            path.unlink()
+    files, size = stage_input(stage, root, cfg)
+    script, stdin_text = STAGES[stage]
+    logs_dir = root / "logs"
+    logs_dir.mkdir(exist_ok=True)
+    # cache_cold e cache_warm scrivono lo stesso report: si toglie quello della fase precedente
+    report_path = root / (cfg.get("metrics", {}).get("report_dir") or REPORT_DIR) / f"{Path(script).stem}.json"
+    if report_path.exists():
+        report_path.unlink()
+    seconds, returncode, peak = run_script(script, stdin_text, root, logs_dir / f"benchmark_{stage}.out")
+    result = {
+        "status": "ok" if returncode == 0 else "failed",
+        "returncode": returncode,
+        "seconds": round(seconds, 3),
+        "files": files,
+        "bytes": size,
+        "files_per_s": round(files / seconds, 1) if seconds else None,
+        "mb_per_s": round(size / 1e6 / seconds, 1) if seconds else None,
+        "peak_rss_mb": round(peak / 2**20, 1) if peak is not None else None,
+        "metrics": stage_metrics(report_path),
+    }
+    rss = f"{result['peak_rss_mb']} MB" if peak is not None else "n/d"
+    log = logging.info if returncode == 0 else logging.error
+    log(f"{'✅' if returncode == 0 else '❌'} {stage}: {files} file in {seconds:.2f}s "
+        f"({result['files_per_s']} file/s, {result['mb_per_s']} MB/s, RSS {rss})")
+    return result
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPTS_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(config: dict) -> Path:
+    bench_cfg = config.get("benchmark", {})
+    stages = bench_cfg.get("stages", list(STAGES))
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        raise ValueError(f"Fasi non supportate: {', '.join(unknown)} (valide: {', '.join(STAGES)})")
+
+    root = Path(bench_cfg.get("root", "bench/albero")).resolve()
+    spec = tree_spec(bench_cfg)
+    prepare_tree(root, spec)
+    bench_config = write_bench_config(root, config)
+    reset_run(root)
+
+    results = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "spec": spec,
+        "stages": {},
+    }
+    for stage in stages:
+        results["stages"][stage] = run_stage(stage, root, bench_config)
+
+    results_dir = Path(bench_cfg.get("results_dir", "bench/risultati"))
+    results_dir.mkdir(parents=True, exist_ok=True)
+    out_path = results_dir / f"{datetime.now():%Y%m%d_%H%M%S}.json"
+    out_path.write_text(json.dumps(results, indent=2), encoding="utf-8")
+    logging.info(f"📊 Risultati salvati in {out_path}")
+    return out_path
+
+def ratio(old, new):
+    return f"×{new / old:.2f}" if old and new else "n/d"
+
+def compare_results(old_path, new_path):
+    """Confronta due file di risultati fase per fase (file/s, MB/s, picco RSS)."""
+    old = json.loads(Path(old_path).read_text(encoding="utf-8"))
+    new = json.loads(Path(new_path).read_text(encoding="utf-8"))
+    if old.get("spec") != new.get("spec"):
+        logging.warning("⚠️  I due run usano alberi sintetici diversi: il confronto non è omogeneo")
+    logging.info(f"📊 {old_path} ({old.get('commit')}) → {new_path} ({new.get('commit')})")
+    for stage, after in new["stages"].items():
+        before = old["stages"].get(stage)
+        if not before:
+            continue
+        if before["status"] != "ok" or after["status"] != "ok":
+            if before["status"] != after["status"]:
+                logging.warning(f"{stage}: esito {before['status']} → {after['status']}")
+            continue
+        logging.info(
+            f"{stage}: file/s {before['files_per_s']} → {after['files_per_s']} "
+            f"({ratio(before['files_per_s'], after['files_per_s'])}), "
+            f"MB/s {before['mb_per_s']} → {after['mb_per_s']} ({ratio(before['mb_per_s'], after['mb_per_s'])}), "
+            f"RSS {before['peak_rss_mb']} → {after['peak_rss_mb']} MB"
+        )
+
+if __name__ == "__main__":
+    setup_logger()
+    if len(sys.argv) == 4 and sys.argv[1] == "confronta":
+        compare_results(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) == 1:
+        run_benchmark(load_config())
+    else:
+        print("Uso: python scripts/benchmark.py [confronta VECCHIO.json NUOVO.json]")
+        sys.exit(2)
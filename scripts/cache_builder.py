@@ -1,9 +1,19 @@
+import os
 import json
-import hashlib
+import time
 import logging
+from functools import partial
+from itertools import chain
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from pathlib import Path
 from tqdm import tqdm
 from datetime import datetime
+import metrics
+from hashing import DEFAULT_ALGORITHM, hash_file, fingerprint_file, fingerprint_prefix
+from hashing import configure_io, configured_algorithm, configured_fingerprint
+from hash_index import open_index, migrate_json_cache, compact_index, dir_key, load_folder, save_files
+from hash_index import delete_files, drop_folder, set_folder_mtime, folder_states
 
 CONFIG_PATH = "config.json"
 LOG_FILE = Path("logs/cache_builder.log")
@@ -24,90 +34,275 @@ def load_config():
     with open(CONFIG_PATH, "r", encoding="utf-8") as f:
         return json.load(f)
 
-def compute_hash(file_path):
-    h = hashlib.sha256()
+@metrics.timed("compute_hash")
+def compute_hash(file_path, algo=DEFAULT_ALGORITHM):
     try:
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(8192), b""):
-                h.update(chunk)
-        return h.hexdigest()
+        return hash_file(file_path, algo)
     except Exception as e:
         logging.warning(f"Errore hashing {file_path}: {e}")
         return None
 
-def process_output_dir(output_dir: Path, cache_dir: Path, valid_exts: set):
-    total_files = 0
-    total_new_hashes = 0
-    start_time = datetime.now()
+@metrics.timed("compute_fingerprint")
+def compute_fingerprint(file_path, algo=DEFAULT_ALGORITHM, samples=8, sample_bytes=1024 * 1024):
+    try:
+        return fingerprint_file(file_path, samples, sample_bytes, algo)
+    except Exception as e:
+        logging.warning(f"Errore impronta {file_path}: {e}")
+        return None
 
-    # Include root + sottocartelle immediate
-    all_dirs = [output_dir] + [d for d in output_dir.iterdir() if d.is_dir()]
+def make_executor(workers: int, kind: str = "thread", cfg: dict = None):
+    """Crea il pool per l'hashing concorrente; None se si lavora in serie.
 
-    for current_dir in all_dirs:
-        rel = current_dir.relative_to(output_dir)
-        current_cache = cache_dir / rel
-        current_cache.mkdir(parents=True, exist_ok=True)
-        cache_file = current_cache / "cache.json"
+    "thread" va bene per dischi lenti (I/O-bound), "process" per SHA-256
+    CPU-bound su dischi veloci (NVMe). Con ``cfg`` ogni processo del pool applica
+    configure_io all'avvio: dove i processi partono da zero (spawn, Windows) non
+    vedrebbero le impostazioni di I/O del processo principale.
+    """
+    if workers <= 1:
+        return None
+    if kind == "process":
+        if cfg is None:
+            return ProcessPoolExecutor(max_workers=workers)
+        return ProcessPoolExecutor(max_workers=workers, initializer=configure_io, initargs=(cfg,))
+    return ThreadPoolExecutor(max_workers=workers)
 
-        # Carica cache esistente
-        if cache_file.exists():
-            try:
-                with open(cache_file, "r", encoding="utf-8") as f:
-                    cache_data = json.load(f)
-            except Exception as e:
-                logging.warning(f"Errore nel parsing di {cache_file}: {e}")
-                cache_data = {"files": {}}
-        else:
-            cache_data = {"files": {}}
-
-        cached = cache_data.get("files", {})
-        new_hashes = 0
-        files = [f for f in current_dir.glob("*.*") if f.suffix.lower() in valid_exts]
-        total_files += len(files)
-
-        for f in tqdm(files, desc=f"[{rel or output_dir.name}]", unit="file"):
-            stat = f.stat()
-            if f.name in cached and cached[f.name].get("mtime") == stat.st_mtime:
-                continue  # hash valido
-            h = compute_hash(f)
-            if h:
-                cached[f.name] = {
-                    "hash": h,
+def hash_files(files, executor=None, algo=DEFAULT_ALGORITHM, fingerprint=None):
+    """Restituisce gli hash di ``files`` nello stesso ordine della lista.
+
+    Con ``fingerprint`` (parametri di configured_fingerprint) calcola invece
+    l'impronta veloce a campioni.
+    """
+    if fingerprint:
+        func = partial(compute_fingerprint, algo=algo, samples=fingerprint["samples"],
+                       sample_bytes=fingerprint["sample_bytes"])
+    else:
+        func = partial(compute_hash, algo=algo)
+    if executor is None:
+        return (func(f) for f in files)
+    # Con i processi conviene spedire i path a blocchi per ridurre l'overhead IPC
+    chunksize = 16 if isinstance(executor, ProcessPoolExecutor) else 1
+    return executor.map(func, files, chunksize=chunksize)
+
+def scan_folder(current_dir: Path, valid_exts: set):
+    """File multimediali (con stat) e sottocartelle di ``current_dir`` in una sola scandir."""
+    files, subdirs = [], []
+    start = time.perf_counter()
+    stat_time = 0.0
+    with os.scandir(current_dir) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif os.path.splitext(entry.name)[1].lower() in valid_exts and entry.is_file():
+                stat_start = time.perf_counter()
+                stat = entry.stat()
+                stat_time += time.perf_counter() - stat_start
+                files.append((Path(entry.path), stat))
+    metrics.add_time("stat", stat_time)
+    metrics.add_time("walk", time.perf_counter() - start - stat_time)
+    metrics.inc("walk_entries", len(files) + len(subdirs))
+    return sorted(files, key=lambda item: item[0].name), sorted(subdirs)
+
+def folder_unchanged(dir_stat, state) -> bool:
+    """Vero se la cartella non ha avuto file o sottocartelle aggiunti, tolti o rinominati.
+
+    Basta l'mtime della cartella; dove st_nlink vale 2 + numero di sottocartelle
+    (ext4, XFS) conferma anche quel conteggio, sempre senza listarla.
+    """
+    if not state or state[1] is None or state[0] != dir_stat.st_mtime:
+        return False
+    return dir_stat.st_nlink < 2 or dir_stat.st_nlink == 2 + state[2]
+
+def update_folder(conn, media: str, rel_dir: str, files: list, bar, executor=None, algo=DEFAULT_ALGORITHM,
+                  fingerprint=None, checkpoint_files=500, checkpoint_seconds=30) -> int:
+    """Calcola hash (o impronte) dei file nuovi o cambiati di una cartella già listata.
+
+    I risultati sono salvati ogni ``checkpoint_files`` file o ``checkpoint_seconds``
+    secondi: se il processo viene interrotto la ripresa non ricalcola nulla.
+    Restituisce quanti file sono stati aggiornati.
+    """
+    cached = load_folder(conn, media, rel_dir)
+    delete_files(conn, media, rel_dir, set(cached) - {f.name for f, _ in files})
+    new_entries = {}
+    new_hashes = 0
+    last_checkpoint = time.monotonic()
+
+    def checkpoint():
+        # Ogni commit è atomico (WAL di SQLite): i file salvati non si ricalcolano
+        nonlocal last_checkpoint
+        save_files(conn, media, rel_dir, new_entries)
+        conn.commit()
+        new_entries.clear()
+        last_checkpoint = time.monotonic()
+
+    to_hash, to_fingerprint = [], []
+    for f, stat in files:
+        entry = cached.get(f.name) or {}
+        valid = entry.get("mtime") == stat.st_mtime and entry.get("algo") == algo
+        if fingerprint and stat.st_size >= fingerprint["min_size"]:
+            if not (valid and (entry.get("fingerprint") or "").startswith(fingerprint_prefix(fingerprint))):
+                to_fingerprint.append((f, stat))
+        elif not (valid and entry.get("hash")):
+            to_hash.append((f, stat))  # un algoritmo diverso va ricalcolato
+    metrics.inc("cache_misses", len(to_hash) + len(to_fingerprint))
+    metrics.inc("cache_hits", len(files) - len(to_hash) - len(to_fingerprint))
+
+    # I risultati arrivano nell'ordine dei file: la cache resta deterministica
+    bar.update(len(files) - len(to_hash) - len(to_fingerprint))
+    hashes = hash_files([f for f, _ in to_hash], executor, algo)
+    fingerprints = hash_files([f for f, _ in to_fingerprint], executor, algo, fingerprint)
+    results = chain(((item, h, None) for item, h in zip(to_hash, hashes)),
+                    ((item, None, fp) for item, fp in zip(to_fingerprint, fingerprints)))
+    try:
+        for (f, stat), h, fp in results:
+            bar.update(1)
+            if h or fp:
+                # Hash parziale (remove_duplicates), percettivo (near_duplicates),
+                # completo e impronta restano validi se il file non è cambiato
+                entry = cached.get(f.name) or {}
+                unchanged = entry.get("mtime") == stat.st_mtime
+                keep = unchanged and entry.get("algo") == algo
+                new_entries[f.name] = {
+                    "hash": h or (entry.get("hash") if keep else None),
                     "mtime": stat.st_mtime,
-                    "size": stat.st_size
+                    "size": stat.st_size,
+                    "partial": entry.get("partial") if keep else None,
+                    "algo": algo,
+                    "phash": entry.get("phash") if unchanged else None,
+                    "fingerprint": fp or (entry.get("fingerprint") if keep else None)
                 }
                 new_hashes += 1
+            if (len(new_entries) >= checkpoint_files
+                    or time.monotonic() - last_checkpoint >= checkpoint_seconds):
+                checkpoint()
+    finally:
+        # Anche se interrotto (Ctrl+C) salva quanto già calcolato
+        checkpoint()
+    return new_hashes
 
-        cache_data["files"] = cached
-        cache_data["folder_mtime"] = current_dir.stat().st_mtime
-        with cache_file.open("w", encoding="utf-8") as cf:
-            json.dump(cache_data, cf, indent=2)
+def process_output_dir(output_dir: Path, conn, media: str, valid_exts: set, executor=None,
+                       algo=DEFAULT_ALGORITHM, fingerprint=None, checkpoint_files=500, checkpoint_seconds=30,
+                       full_scan=False):
+    """Aggiorna l'indice per ``output_dir`` e tutte le sue sottocartelle.
 
-        total_new_hashes += new_hashes
-        logging.info(f"{current_dir} → nuovi hash aggiunti: {new_hashes}/{len(files)}")
+    Le cartelle invariate dall'ultima esecuzione (folder_unchanged) non vengono
+    listate e i loro file non vengono controllati: le sottocartelle note si leggono
+    dall'indice. Un file modificato sul posto non cambia l'mtime della cartella,
+    quindi ``full_scan`` ricontrolla comunque ogni file.
+    Con ``fingerprint`` i file da ``min_size`` byte in su ricevono solo l'impronta
+    veloce: l'hash completo viene calcolato da chi deve confermare una corrispondenza.
+    Lo stato di una cartella si salva prima di visitarne le sottocartelle: se
+    un'interruzione ne lascia alcune fuori dall'indice, le sottocartelle note sono
+    meno di quelle registrate e la cartella viene rilistata anche se invariata.
+    """
+    if not output_dir.is_dir():
+        logging.error(f"La cartella di output non esiste: {output_dir}")
+        return
+    total_files = 0
+    total_new_hashes = 0
+    skipped_dirs = 0
+    start_time = datetime.now()
+
+    known = folder_states(conn, media)
+    children = defaultdict(list)
+    for rel_dir in known:
+        if rel_dir:
+            children[dir_key(Path(rel_dir).parent)].append(rel_dir)
+
+    stack = [""]
+    with tqdm(desc=f"[{output_dir.name}]", unit="file") as bar:
+        while stack:
+            rel_dir = stack.pop()
+            current_dir = output_dir / rel_dir
+            try:
+                # Letto prima della scansione: un file aggiunto nel frattempo fa rilistare la cartella
+                dir_stat = current_dir.stat()
+            except FileNotFoundError:
+                drop_folder(conn, media, rel_dir)
+                conn.commit()
+                continue
+
+            state = known.get(rel_dir)
+            if state and len(children[rel_dir]) != state[2]:
+                # Sottocartelle mai completate (esecuzione interrotta): si rilista
+                metrics.inc("folders_incomplete")
+            elif not full_scan and folder_unchanged(dir_stat, state):
+                skipped_dirs += 1
+                metrics.inc("folders_skipped")
+                metrics.inc("cache_hits", state[1])
+                total_files += state[1]
+                bar.update(state[1])
+                stack.extend(sorted(children[rel_dir], reverse=True))
+                continue
+
+            files, subdirs = scan_folder(current_dir, valid_exts)
+            metrics.inc("folders_scanned")
+            sub_keys = [dir_key(Path(rel_dir) / name) for name in subdirs]
+            for gone in set(children[rel_dir]) - set(sub_keys):
+                drop_folder(conn, media, gone)
+            stack.extend(reversed(sub_keys))
+
+            new_hashes = update_folder(conn, media, rel_dir, files, bar, executor, algo, fingerprint,
+                                       checkpoint_files, checkpoint_seconds)
+            # Lo stato della cartella si registra solo a cartella completa
+            set_folder_mtime(conn, media, rel_dir, dir_stat.st_mtime, len(files), len(subdirs))
+            conn.commit()
+
+            total_files += len(files)
+            total_new_hashes += new_hashes
+            if new_hashes:
+                logging.info(f"{current_dir} → nuovi hash aggiunti: {new_hashes}/{len(files)}")
 
     duration = (datetime.now() - start_time).total_seconds()
     logging.info(f"\n✅ Totale file analizzati: {total_files}")
+    logging.info(f"📁 Cartelle invariate saltate: {skipped_dirs}")
     logging.info(f"➕ Totale nuovi hash calcolati: {total_new_hashes}")
     logging.info(f"⏱️ Tempo impiegato: {duration:.2f} secondi")
 
-def main():
-    setup_logger()
-    cfg = load_config()
+def update_cache(cfg: dict):
+    """Aggiorna l'indice per le cartelle di output di foto e video."""
+    algo = configured_algorithm(cfg)
+    configure_io(cfg)
+    cache_cfg = cfg.get("cache", {})
+    workers = cache_cfg.get("workers", 1)
+    executor = make_executor(workers, cache_cfg.get("executor", "thread"), cfg)
+    if executor:
+        logging.info(f"⚙️ Hashing concorrente: {workers} worker ({cache_cfg.get('executor', 'thread')})")
+
+    fingerprint = configured_fingerprint(cfg)
+    if fingerprint:
+        logging.info(f"⚡ Impronta veloce per i file da {fingerprint['min_size'] / 1024 ** 2:.0f} MB in su")
+
+    checkpoint_files = cache_cfg.get("checkpoint_files", 500)
+    checkpoint_seconds = cache_cfg.get("checkpoint_seconds", 30)
+    full_scan = cache_cfg.get("full_scan", False)
+
+    conn = open_index()
+    migrate_json_cache(conn)
 
     # Foto
     photo_dir = Path(cfg["output"]["foto"])
-    photo_cache = Path("cache/foto")
     photo_exts = set(e.lower() for e in cfg["media"]["photo_extensions"])
     logging.info("📸 Aggiorno cache per FOTO")
-    process_output_dir(photo_dir, photo_cache, photo_exts)
+    process_output_dir(photo_dir, conn, "foto", photo_exts, executor, algo, fingerprint,
+                       checkpoint_files, checkpoint_seconds, full_scan)
 
     # Video
     video_dir = Path(cfg["output"]["video"])
-    video_cache = Path("cache/video")
     video_exts = set(e.lower() for e in cfg["media"]["video_extensions"])
     logging.info("\n🎞️ Aggiorno cache per VIDEO")
-    process_output_dir(video_dir, video_cache, video_exts)
+    process_output_dir(video_dir, conn, "video", video_exts, executor, algo, fingerprint,
+                       checkpoint_files, checkpoint_seconds, full_scan)
+
+    compact_index(conn)
+    conn.close()
+    if executor:
+        executor.shutdown()
+
+def main():
+    setup_logger()
+    cfg = load_config()
+    metrics.start_run("cache_builder", cfg)
+    update_cache(cfg)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,154 @@
+import os
+import time
+import logging
+from pathlib import Path
+from tqdm import tqdm
+import metrics
+from cache_builder import setup_logger, load_config, make_executor, process_output_dir, scan_folder, update_folder
+from hashing import configure_io, configured_algorithm, configured_fingerprint
+from hash_index import open_index, migrate_json_cache, compact_index, dir_key, drop_folder, set_folder_mtime
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = flags = None
+
+# Dopo una raffica continua di eventi si aggiorna comunque entro questo multiplo del debounce
+MAX_DELAY_FACTOR = 10
+
+class CacheWatcher:
+    """Tiene l'indice aggiornato seguendo gli eventi inotify delle cartelle di output.
+
+    Gli eventi vengono raccolti per cartella; passati ``debounce`` secondi senza
+    nuovi eventi, ogni cartella toccata viene rilistata e update_folder ricalcola
+    solo i file nuovi o modificati e toglie quelli cancellati.
+    """
+
+    def __init__(self, conn, roots: dict, debounce: float = 2.0, **options):
+        if INotify is None:
+            raise ImportError("La modalità watch richiede il pacchetto inotify_simple (pip install inotify_simple)")
+        self.conn = conn
+        self.roots = roots  # {media: (output_dir, valid_exts)}
+        self.debounce = debounce
+        self.options = options  # executor, algo, fingerprint, checkpoint_* per update_folder
+        self.inotify = INotify()
+        self.mask = (flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM
+                     | flags.DELETE | flags.DELETE_SELF | flags.ATTRIB)
+        self.watches = {}  # wd -> (media, rel_dir)
+
+    def watch_tree(self, media: str, rel_dir: str = "") -> list:
+        """Aggiunge un watch per ogni cartella del sottoalbero; restituisce le cartelle."""
+        output_dir = self.roots[media][0]
+        added = []
+        for dirpath, dirnames, _ in os.walk(output_dir / rel_dir):
+            dirnames.sort()
+            key = dir_key(Path(dirpath).relative_to(output_dir))
+            try:
+                self.watches[self.inotify.add_watch(dirpath, self.mask)] = (media, key)
+            except OSError as e:
+                logging.warning(f"Impossibile osservare {dirpath}: {e}")
+                continue
+            added.append((media, key))
+        return added
+
+    def rescan(self):
+        for media, (output_dir, valid_exts) in self.roots.items():
+            process_output_dir(output_dir, self.conn, media, valid_exts, **self.options)
+            self.watch_tree(media)
+
+    def refresh(self, media: str, rel_dir: str) -> int:
+        output_dir, valid_exts = self.roots[media]
+        current_dir = output_dir / rel_dir
+        try:
+            dir_stat = current_dir.stat()
+            files, subdirs = scan_folder(current_dir, valid_exts)
+        except FileNotFoundError:
+            drop_folder(self.conn, media, rel_dir)
+            self.conn.commit()
+            return 0
+        with tqdm(disable=True) as bar:
+            updated = update_folder(self.conn, media, rel_dir, files, bar, **self.options)
+        set_folder_mtime(self.conn, media, rel_dir, dir_stat.st_mtime, len(files), len(subdirs))
+        self.conn.commit()
+        return updated
+
+    def handle(self, event, pending: set) -> bool:
+        """Registra un evento in ``pending``; False se serve una scansione completa."""
+        if event.mask & flags.Q_OVERFLOW:
+            return False
+        if event.mask & flags.IGNORED:
+            self.watches.pop(event.wd, None)
+            return True
+        if event.wd not in self.watches:
+            return True
+        media, rel_dir = self.watches[event.wd]
+        if event.mask & flags.ISDIR and event.name:
+            sub_dir = dir_key(Path(rel_dir) / event.name)
+            if event.mask & (flags.CREATE | flags.MOVED_TO):
+                # I file creati prima del watch non generano eventi: la cartella va listata
+                pending.update(self.watch_tree(media, sub_dir))
+            elif event.mask & (flags.DELETE | flags.MOVED_FROM):
+                drop_folder(self.conn, media, sub_dir)
+                self.conn.commit()
+        pending.add((media, rel_dir))
+        return True
+
+    def run(self):
+        self.rescan()
+        logging.info(f"👀 In ascolto su {len(self.watches)} cartelle (debounce {self.debounce}s)")
+        pending = set()
+        first_event = None
+        while True:
+            events = self.inotify.read(timeout=int(self.debounce * 1000))
+            complete = True
+            for event in events:
+                complete = self.handle(event, pending) and complete
+            if not complete:
+                logging.warning("Coda inotify piena: scansione completa")
+                pending.clear()
+                self.rescan()
+                continue
+            if pending and first_event is None:
+                first_event = time.monotonic()
+            if pending and (not events or time.monotonic() - first_event >= MAX_DELAY_FACTOR * self.debounce):
+                updated = sum(self.refresh(media, rel_dir) for media, rel_dir in sorted(pending))
+                logging.info(f"🔄 Cartelle aggiornate: {len(pending)}, file ricalcolati: {updated}")
+                metrics.inc("watch_refreshes")
+                # Il textfile resta aggiornato per tutto il tempo in cui il watcher gira
+                metrics.write_reports()
+                pending.clear()
+                first_event = None
+
+def main():
+    setup_logger()
+    cfg = load_config()
+    metrics.start_run("cache_watch", cfg)
+    configure_io(cfg)
+    cache_cfg = cfg.get("cache", {})
+    executor = make_executor(cache_cfg.get("workers", 1), cache_cfg.get("executor", "thread"), cfg)
+    conn = open_index()
+    migrate_json_cache(conn)
+    roots = {
+        "foto": (Path(cfg["output"]["foto"]), set(e.lower() for e in cfg["media"]["photo_extensions"])),
+        "video": (Path(cfg["output"]["video"]), set(e.lower() for e in cfg["media"]["video_extensions"])),
+    }
+    watcher = CacheWatcher(
+        conn, roots, cache_cfg.get("watch_debounce", 2.0),
+        executor=executor,
+        algo=configured_algorithm(cfg),
+        fingerprint=configured_fingerprint(cfg),
+        checkpoint_files=cache_cfg.get("checkpoint_files", 500),
+        checkpoint_seconds=cache_cfg.get("checkpoint_seconds", 30),
+    )
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        logging.info("Interrotto")
+    finally:
+        compact_index(conn)
+        conn.close()
+        if executor:
+            executor.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import os
+import time
+import logging
+from pathlib import Path
+import numpy as np
+import torch
+import clip
+from decode import decodifica_ridotta
+
+CLIP_MODEL = "ViT-B/32"
+BACKENDS = ("torch", "int8")
+# Encoder immagini quantizzato, esportato in TorchScript alla prima esecuzione
+INT8_MODEL_PATH = Path("cache/clip_vit_b32_int8.pt")
+
+def imposta_thread(threads: int):
+    """Thread intra-op di PyTorch (0 = scelta di PyTorch, di solito tutti i core)."""
+    if threads:
+        torch.set_num_threads(threads)
+
+def encoder_int8(model, path: Path = INT8_MODEL_PATH):
+    """Encoder immagini CLIP con i Linear quantizzati int8 in modo dinamico (solo CPU)."""
+    if path.exists():
+        return torch.jit.load(str(path), map_location="cpu")
+    visual = model.visual.float().eval()
+    quantizzato = torch.quantization.quantize_dynamic(visual, {torch.nn.Linear}, dtype=torch.qint8)
+    esempio = torch.zeros(1, 3, visual.input_resolution, visual.input_resolution)
+    with torch.no_grad():
+        tracciato = torch.jit.trace(quantizzato, esempio)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    torch.jit.save(tracciato, str(path))
+    logging.info(f"📦 Encoder CLIP int8 salvato in {path}")
+    return tracciato
+
+def carica_clip(backend: str = "torch", threads: int = 0):
+    """Restituisce (model, preprocess, encode_image, device) per il backend scelto.
+
+    ``model`` resta quello fp32 di clip (serve per il testo e per logit_scale);
+    ``encode_image`` è la funzione da usare sulle immagini.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Backend CLIP non supportato: {backend} (validi: {', '.join(BACKENDS)})")
+    imposta_thread(threads)
+    device = "cuda" if backend == "torch" and torch.cuda.is_available() else "cpu"
+    model, preprocess = clip.load(CLIP_MODEL, device=device)
+    if backend == "int8":
+        return model, preprocess, encoder_int8(model), device
+    return model, preprocess, model.encode_image, device
+
+def codifica(encode_image, preprocess, percorsi, batch_size: int = 32):
+    """Embedding normalizzati (float32) di ``percorsi``, decodificati come in organise."""
+    vettori = []
+    for i in range(0, len(percorsi), batch_size):
+        tensori = torch.stack([preprocess(decodifica_ridotta(p)[0]) for p in percorsi[i:i + batch_size]])
+        with torch.no_grad():
+            features = encode_image(tensori).float()
+        vettori.append((features / features.norm(dim=-1, keepdim=True)).numpy())
+    return np.concatenate(vettori)
+
+def confronta_backend(percorsi, etichette, threads: int = 0, batch_size: int = 32) -> dict:
+    """Confronta int8 e fp32 su CPU sugli stessi file: somiglianza, etichette e velocità."""
+    model, preprocess, encode_int8, _ = carica_clip("int8", threads)
+    with torch.no_grad():
+        testo = model.encode_text(clip.tokenize(etichette)).float()
+        testo /= testo.norm(dim=-1, keepdim=True)
+    scala = model.logit_scale.exp().float().item()
+
+    risultati = {}
+    for backend, encode_image in (("torch", model.encode_image), ("int8", encode_int8)):
+        inizio = time.perf_counter()
+        vettori = codifica(encode_image, preprocess, percorsi, batch_size)
+        durata = time.perf_counter() - inizio
+        probs = torch.from_numpy(scala * vettori @ testo.numpy().T).softmax(dim=-1).numpy()
+        risultati[backend] = (vettori, probs.argmax(axis=1), len(percorsi) / durata)
+
+    (fp32, etichette_fp32, velocita_fp32), (int8, etichette_int8, velocita_int8) = risultati["torch"], risultati["int8"]
+    coseni = (fp32 * int8).sum(axis=1)
+    return {
+        "immagini": len(percorsi),
+        "coseno_medio": float(coseni.mean()),
+        "coseno_minimo": float(coseni.min()),
+        "etichette_uguali": float((etichette_fp32 == etichette_int8).mean()),
+        "img_s_fp32": velocita_fp32,
+        "img_s_int8": velocita_int8,
+    }
+
+if __name__ == "__main__":
+    import organise
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    organise.configura(organise.load_config())
+    organise_cfg = organise.config.get("organise", {})
+    campione = organise_cfg.get("compare_sample", 200)
+    immagini = sorted(f for f in os.listdir(organise.foto_dir) if f.lower().endswith(organise.estensioni_valide))
+    # Campione deterministico distribuito su tutta la cartella
+    passo = max(1, len(immagini) // campione) if campione else 1
+    percorsi = [os.path.join(organise.foto_dir, f) for f in immagini[::passo][:campione]]
+
+    report = confronta_backend(percorsi, organise.etichette, organise_cfg.get("clip_threads", 0), organise.batch_size)
+    logging.info(f"📊 Confronto int8/fp32 su {report['immagini']} immagini")
+    logging.info(f"Similarità coseno media {report['coseno_medio']:.4f}, minima {report['coseno_minimo']:.4f}")
+    logging.info(f"Stessa etichetta nel {report['etichette_uguali']:.1%} dei casi")
+    logging.info(f"Immagini/s: fp32 {report['img_s_fp32']:.1f}, int8 {report['img_s_int8']:.1f}")
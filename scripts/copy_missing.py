@@ -1,8 +1,15 @@
-import shutil
+import os
 import logging
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from tqdm import tqdm
+import metrics
+from hashing import DEFAULT_ALGORITHM, configure_io, configured_algorithm, hash_file
+from placement import place_file
+from hash_index import open_index, record_file
+from extract_media import reserve_name
 
 def setup_logger():
     logs_dir = Path("logs")
@@ -37,48 +44,193 @@ def load_missing_list(path):
                     continue
     return results
 
-def copy_files_from_missing(missing_file, output_folder, label):
+def journal_path_for(missing_file) -> Path:
+    return Path(missing_file).with_suffix(".journal")
+
+def previous_journal_path(journal_path: Path) -> Path:
+    """Journal dell'ultima esecuzione completata, tenuto al posto di uno che cresce sempre."""
+    return journal_path.with_name(journal_path.name + ".prev")
+
+def load_journal(path: Path) -> dict:
+    """Copie già completate in esecuzioni precedenti: {sorgente: (destinazione, size)}."""
+    done = {}
+    if path.exists():
+        for line in path.read_text(encoding="utf-8").splitlines():
+            parts = line.split("\t")
+            if len(parts) == 3:
+                try:
+                    done[parts[0]] = (Path(parts[1]), int(parts[2]))
+                except ValueError:
+                    continue
+    return done
+
+def unjournaled_copy(src_path: Path, output_folder: Path, size: int, taken: set, claimed: set,
+                     algo: str = DEFAULT_ALGORITHM) -> Path:
+    """Copia già completa ma assente dal journal (esecuzione interrotta), o None.
+
+    Prova i nomi che reserve_name avrebbe scelto: il primo file esistente con la
+    dimensione attesa, non già assegnato a un'altra sorgente e con lo stesso hash
+    della sorgente è la copia. Da usare solo riprendendo un'esecuzione interrotta.
+    """
+    name = src_path.name
+    i = 1
+    src_hash = None
+    while os.path.normcase(name) in taken:
+        dest = output_folder / name
+        if os.path.normcase(name) not in claimed and dest.is_file() and dest.stat().st_size == size:
+            src_hash = src_hash or hash_file(src_path, algo)
+            if hash_file(dest, algo) == src_hash:
+                return dest
+        name = f"{src_path.stem}_{i}{src_path.suffix}"
+        i += 1
+    return None
+
+@metrics.timed("copy_file")
+def copy_one(src_path: Path, dest: Path, size: int, placement: str, algo=None, journal=None, lock=None):
+    """Copia su un file .part e lo rinomina solo se la dimensione è quella attesa.
+
+    La copia finisce nel ``journal`` appena rinominata, dal thread che l'ha fatta:
+    anche se l'esecuzione viene interrotta subito dopo, alla ripresa non si duplica.
+    """
+    part = dest.with_name(dest.name + ".part")
+    if part.exists():
+        part.unlink()  # resto di una copia interrotta
+    h = place_file(src_path, part, placement, algo)
+    copied_size = part.stat().st_size
+    if copied_size != size:
+        part.unlink()
+        raise IOError(f"dimensione copiata {copied_size} diversa da quella attesa {size}")
+    os.replace(part, dest)
+    if journal is not None:
+        with lock:
+            journal.write(f"{src_path}\t{dest}\t{size}\n")
+            journal.flush()
+    return h
+
+def copy_files_from_missing(missing_file, output_folder, label, conn=None, algo=DEFAULT_ALGORITHM,
+                            placement="copy", workers=1):
     output_folder = Path(output_folder)
     output_folder.mkdir(parents=True, exist_ok=True)
 
     files = load_missing_list(missing_file)
+    journal_path = journal_path_for(missing_file)
+    previous_path = previous_journal_path(journal_path)
+    # Il journal resta solo se l'ultima esecuzione è stata interrotta
+    resuming = journal_path.exists()
+    done = load_journal(previous_path)
+    done.update(load_journal(journal_path))
+    taken = {os.path.normcase(n) for n in os.listdir(output_folder)}
+    # Nomi di output già assegnati a una sorgente dal journal
+    claimed = {os.path.normcase(dest.name) for dest, _ in done.values() if dest.parent == output_folder}
     copied = 0
     not_found = 0
+    resumed = 0
+    failed = 0
+    lock = threading.Lock()
 
-    for name, size, src_path in tqdm(files, desc=f"Copia {label.upper()}"):
-        if src_path.exists():
-            dest = output_folder / src_path.name
-            i = 1
-            while dest.exists():
-                dest = output_folder / f"{src_path.stem}_{i}{src_path.suffix}"
-                i += 1
+    with journal_path.open("a", encoding="utf-8") as journal:
+        jobs = []
+        for name, size, src_path in files:
+            previous = done.get(str(src_path))
+            if previous and previous[0].exists() and previous[0].stat().st_size == size:
+                resumed += 1  # già copiato in un'esecuzione interrotta
+                continue
+            if not src_path.exists():
+                logging.warning(f"⚠️  Non trovato: {src_path}")
+                not_found += 1
+                continue
+            dest = unjournaled_copy(src_path, output_folder, size, taken, claimed, algo) if resuming else None
+            if dest is not None:
+                # Copiato ma interrotto prima di scrivere il journal: si registra ora
+                claimed.add(os.path.normcase(dest.name))
+                journal.write(f"{src_path}\t{dest}\t{size}\n")
+                resumed += 1
+                continue
+            jobs.append((src_path, size, reserve_name(src_path, output_folder, taken)))
+        journal.flush()
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {
+                pool.submit(copy_one, src_path, dest, size, placement, algo if conn else None, journal, lock):
+                    (src_path, size, dest)
+                for src_path, size, dest in jobs
+            }
             try:
-                shutil.copy2(src_path, dest)
-                copied += 1  # Nessun log per copie riuscite
-            except Exception as e:
-                logging.error(f"❌ Errore copiando {src_path}: {e}")
-        else:
-            logging.warning(f"⚠️  Non trovato: {src_path}")
-            not_found += 1
+                for future in tqdm(as_completed(futures), total=len(futures), desc=f"Copia {label.upper()}"):
+                    src_path, size, dest = futures[future]
+                    try:
+                        h = future.result()
+                    except Exception as e:
+                        logging.error(f"❌ Errore copiando {src_path}: {e}")
+                        failed += 1
+                        continue
+                    if conn is not None:
+                        # Hash calcolato durante la copia e salvato subito in cache
+                        record_file(conn, label, output_folder, dest, h, algo)
+                        conn.commit()
+                    metrics.inc("copy_files")
+                    metrics.inc("copy_bytes", size)
+                    copied += 1  # Nessun log per copie riuscite
+            except KeyboardInterrupt:
+                # Le copie in corso finiscono (e vanno nel journal), quelle in coda no
+                pool.shutdown(cancel_futures=True)
+                raise
+
+    # Esecuzione completata: il journal riparte vuoto e le copie dell'elenco attuale
+    # passano in .prev, così rilanciare lo stesso elenco non le duplica
+    listed = {str(src_path) for _, _, src_path in files}
+    done.update(load_journal(journal_path))
+    tmp = previous_path.with_name(previous_path.name + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        for src, (dest, size) in done.items():
+            if src in listed:
+                f.write(f"{src}\t{dest}\t{size}\n")
+    os.replace(tmp, previous_path)
+    journal_path.unlink()
 
     print(f"\n📦 Riepilogo copia {label.upper()}:")
     print(f"- Totale da copiare: {len(files)}")
     print(f"- Copiati con successo: {copied}")
+    print(f"- Già copiati in precedenza: {resumed}")
+    print(f"- Errori: {failed}")
     print(f"- Non trovati: {not_found}")
-    logging.info(f"\n📦 Riepilogo copia {label.upper()}: {copied} copiati, {not_found} non trovati.")
+    logging.info(f"\n📦 Riepilogo copia {label.upper()}: {copied} copiati, {resumed} ripresi, "
+                 f"{failed} errori, {not_found} non trovati.")
 
-if __name__ == "__main__":
-    setup_logger()
-    config = load_config()
+def copy_missing(config: dict):
+    """Copia in output i file degli elenchi di find_missing, foto e video."""
+    algo = configured_algorithm(config)
+    configure_io(config)
+    copy_cfg = config.get("copy", {})
+    placement = copy_cfg.get("placement", "copy")
+    workers = copy_cfg.get("workers", 1)
+    conn = open_index() if copy_cfg.get("hash_on_copy", False) else None
 
     copy_files_from_missing(
         missing_file=config["missing_lists"]["foto"],
         output_folder=config["output"]["foto"],
-        label="foto"
+        label="foto",
+        conn=conn,
+        algo=algo,
+        placement=placement,
+        workers=workers
     )
 
     copy_files_from_missing(
         missing_file=config["missing_lists"]["video"],
         output_folder=config["output"]["video"],
-        label="video"
+        label="video",
+        conn=conn,
+        algo=algo,
+        placement=placement,
+        workers=workers
     )
+
+    if conn:
+        conn.close()
+
+if __name__ == "__main__":
+    setup_logger()
+    config = load_config()
+    metrics.start_run("copy_missing", config)
+    copy_missing(config)
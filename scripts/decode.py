@@ -0,0 +1,110 @@
+import io
+from math import ceil
+from PIL import Image, ExifTags
+
+try:
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+except ImportError:  # senza pillow-heif i file HEIC non si aprono
+    pass
+
+# Tag EXIF Orientation → trasposizione che raddrizza l'immagine (come ImageOps.exif_transpose)
+ORIENTAMENTI = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# Lato corto usato da CLIP ViT-B/32: preprocess ridimensiona a 224 e ritaglia al centro
+LATO_CLIP = 224
+# Media e deviazione standard per canale RGB del Normalize di preprocess
+MEDIA_CLIP = (0.48145466, 0.4578275, 0.40821073)
+DEVIAZIONE_CLIP = (0.26862954, 0.26130258, 0.27577711)
+# Scarto relativo ammesso tra le proporzioni della miniatura EXIF e quelle dell'originale
+TOLLERANZA_PROPORZIONI = 0.01
+
+def miniatura_exif(immagine, larghezza: int, altezza: int):
+    """Miniatura JPEG incorporata negli EXIF, se almeno grande quanto richiesto.
+
+    Le miniature con proporzioni diverse dall'originale (bande nere, ad esempio
+    160x120 per un 16:9) vengono scartate: deformerebbero l'immagine e il
+    fattore di scala, calcolato sulla sola larghezza.
+    """
+    raw = immagine.info.get("exif")
+    if not raw or not hasattr(ExifTags, "IFD"):
+        return None
+    if raw.startswith(b"Exif\x00\x00"):
+        raw = raw[6:]
+    try:
+        ifd1 = immagine.getexif().get_ifd(ExifTags.IFD.IFD1)
+        offset, lunghezza = ifd1.get(0x0201), ifd1.get(0x0202)
+        if not offset or not lunghezza:
+            return None
+        miniatura = Image.open(io.BytesIO(raw[offset:offset + lunghezza]))
+        miniatura.load()
+    except Exception:
+        return None
+    if miniatura.width < larghezza or miniatura.height < altezza:
+        return None
+    proporzioni = immagine.width / immagine.height
+    if abs(miniatura.width / miniatura.height - proporzioni) > TOLLERANZA_PROPORZIONI * proporzioni:
+        return None
+    return miniatura
+
+def decodifica_ridotta(immagine_path, lato_lungo: int = 0, lato_corto: int = LATO_CLIP,
+                       orienta: bool = False):
+    """Decodifica l'immagine una volta sola, alla risoluzione minima utile.
+
+    Il risultato ha il lato lungo >= ``lato_lungo`` e il lato corto >= ``lato_corto``
+    (0 = nessun vincolo) quando l'originale lo permette. Per i JPEG si usa la
+    miniatura EXIF se basta, altrimenti la riduzione DCT di ``draft()``.
+    Con ``orienta`` applica la rotazione EXIF (il fattore di scala resta riferito
+    alla larghezza originale). Restituisce l'immagine RGB e il fattore di scala.
+    """
+    immagine = Image.open(immagine_path)
+    larghezza, altezza = immagine.size
+    orientamento = immagine.getexif().get(0x0112) if orienta else None
+    fattori = []
+    if lato_lungo:
+        fattori.append(max(larghezza, altezza) / lato_lungo)
+    if lato_corto:
+        fattori.append(min(larghezza, altezza) / lato_corto)
+    fattore = min(fattori) if fattori else 1
+    if fattore > 1:
+        richiesta = (ceil(larghezza / fattore), ceil(altezza / fattore))
+        miniatura = miniatura_exif(immagine, *richiesta)
+        if miniatura is not None:
+            immagine = miniatura
+        else:
+            immagine.draft("RGB", richiesta)
+    immagine = immagine.convert("RGB")
+    scala = larghezza / immagine.width
+    if orientamento in ORIENTAMENTI:
+        immagine = immagine.transpose(ORIENTAMENTI[orientamento])
+    return immagine, scala
+
+def preprocessa_clip(immagine):
+    """Il preprocess di CLIP senza torch: array float32 (3, LATO_CLIP, LATO_CLIP).
+
+    Come Resize, CenterCrop, ToTensor e Normalize di torchvision: lato corto a
+    LATO_CLIP (bicubico), ritaglio centrale, valori in [0, 1] normalizzati per
+    canale. Gira nei processi del pool; il processo principale fa solo lo stack.
+    """
+    import numpy as np
+    larghezza, altezza = immagine.size
+    if larghezza <= altezza:
+        dimensioni = (LATO_CLIP, int(LATO_CLIP * altezza / larghezza))
+    else:
+        dimensioni = (int(LATO_CLIP * larghezza / altezza), LATO_CLIP)
+    if dimensioni != immagine.size:
+        immagine = immagine.resize(dimensioni, Image.BICUBIC)
+    sinistra = int(round((immagine.width - LATO_CLIP) / 2.0))
+    alto = int(round((immagine.height - LATO_CLIP) / 2.0))
+    immagine = immagine.crop((sinistra, alto, sinistra + LATO_CLIP, alto + LATO_CLIP)).convert("RGB")
+    array = np.asarray(immagine, dtype=np.float32) / 255.0
+    array = (array - np.array(MEDIA_CLIP, dtype=np.float32)) / np.array(DEVIAZIONE_CLIP, dtype=np.float32)
+    return np.ascontiguousarray(array.transpose(2, 0, 1))
@@ -0,0 +1,28 @@
+import os
+import numpy as np
+from pathlib import Path
+
+# Embedding CLIP (ViT-B/32, normalizzati) delle immagini, una riga per contenuto
+EMBEDDINGS_PATH = Path("cache/clip_embeddings.f16")
+EMBEDDING_DIM = 512
+ROW_BYTES = EMBEDDING_DIM * np.dtype(np.float16).itemsize
+
+def append_embeddings(vettori, path: Path = EMBEDDINGS_PATH) -> int:
+    """Accoda i vettori in float16 e restituisce l'indice della prima riga scritta."""
+    vettori = np.asarray(vettori, dtype=np.float16).reshape(-1, EMBEDDING_DIM)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    size = path.stat().st_size if path.exists() else 0
+    if size % ROW_BYTES:
+        # Riga incompleta lasciata da un'esecuzione interrotta
+        size -= size % ROW_BYTES
+        os.truncate(path, size)
+    with open(path, "ab") as f:
+        f.write(vettori.tobytes())
+    return size // ROW_BYTES
+
+def load_embeddings(path: Path = EMBEDDINGS_PATH) -> np.ndarray:
+    """Tutti gli embedding salvati, mappati in memoria senza caricarli."""
+    if not path.exists() or path.stat().st_size < ROW_BYTES:
+        return np.zeros((0, EMBEDDING_DIM), dtype=np.float16)
+    rows = path.stat().st_size // ROW_BYTES
+    return np.memmap(path, dtype=np.float16, mode="r", shape=(rows, EMBEDDING_DIM))
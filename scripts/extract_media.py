@@ -1,9 +1,17 @@
 import os
-import shutil
 import logging
+import threading
 from pathlib import Path
 import json
 from tqdm import tqdm
+import metrics
+from hashing import DEFAULT_ALGORITHM, configure_io, configured_algorithm
+from placement import place_file
+from hash_index import open_index, record_file
+from io_scheduler import DeviceScheduler, configured_concurrency
+
+# File consecutivi della visita ordinati insieme per inode prima di essere copiati
+INODE_BATCH = 256
 
 def setup_logger():
     logs_dir = Path("logs")
@@ -26,18 +34,60 @@ def load_config():
 def is_media_file(file_path, extensions):
     return file_path.suffix.lower() in extensions
 
-def copy_file(src_path, dst_folder):
-    dst_folder.mkdir(parents=True, exist_ok=True)
-    dest_path = dst_folder / src_path.name
+def walk_media(root: Path, extensions: set):
+    """Visita ricorsiva con os.scandir: filtra per estensione prima di qualsiasi stat.
+
+    Restituisce (path, st_dev, st_ino): il disco è quello della cartella (una stat
+    per cartella), l'inode arriva da readdir senza stat del file.
+    """
+    stack = [str(root)]
+    while stack:
+        current = stack.pop()
+        try:
+            st_dev = os.stat(current).st_dev
+            with os.scandir(current) as entries:
+                subdirs = []
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in extensions and entry.is_file():
+                        yield Path(entry.path), st_dev, entry.inode()
+        except OSError as e:
+            logging.warning(f"Impossibile leggere {current}: {e}")
+            continue
+        stack.extend(reversed(sorted(subdirs)))
+
+def reserve_name(src_path: Path, dst_folder: Path, taken: set) -> Path:
+    """Nome libero in ``dst_folder`` cercato nell'insieme ``taken`` invece che sul disco."""
+    name = src_path.name
     i = 1
-    while dest_path.exists():
-        dest_path = dst_folder / f"{src_path.stem}_{i}{src_path.suffix}"
+    while os.path.normcase(name) in taken:
+        name = f"{src_path.stem}_{i}{src_path.suffix}"
         i += 1
-    shutil.copy2(src_path, dest_path)
+    taken.add(os.path.normcase(name))
+    return dst_folder / name
+
+@metrics.timed("copy_file")
+def copy_file(src_path, dst_folder, conn=None, media=None, algo=DEFAULT_ALGORITHM, placement="copy",
+              dest_path=None):
+    """Copia in ``dst_folder``; con ``conn`` calcola l'hash durante la copia e lo salva in cache."""
+    dst_folder.mkdir(parents=True, exist_ok=True)
+    if dest_path is None:
+        dest_path = dst_folder / src_path.name
+        i = 1
+        while dest_path.exists():
+            dest_path = dst_folder / f"{src_path.stem}_{i}{src_path.suffix}"
+            i += 1
+    h = place_file(src_path, dest_path, placement, algo if conn else None)
+    metrics.inc("copy_files")
+    metrics.inc("copy_bytes", dest_path.stat().st_size)
+    if conn is not None:
+        record_file(conn, media, dst_folder, dest_path, h, algo)
+        conn.commit()
     logging.info(f"Copiato: {src_path} → {dest_path}")
 
-def scan_and_copy():
-    config = load_config()
+def scan_and_copy(config: dict = None):
+    config = config or load_config()
     source = config["sources"]["initial"]
     output_photo = Path(config["output"]["foto"])
     output_video = Path(config["output"]["video"])
@@ -50,28 +100,64 @@ def scan_and_copy():
         logging.error(f"La sorgente '{source}' non esiste.")
         return
 
-    all_files = []
+    algo = configured_algorithm(config)
+    configure_io(config)
+    copy_cfg = config.get("copy", {})
+    placement = copy_cfg.get("placement", "copy")
+    hash_on_copy = copy_cfg.get("hash_on_copy", False)
+    concurrency = configured_concurrency(config)
 
     # Log sottodirectory principali
     for item in src_path.iterdir():
         if item.is_dir():
             logging.info(f"Analizzando la sottodirectory: {item}")
 
-    for file in src_path.rglob("*.*"):
-        if file.is_file():
-            all_files.append(file)
+    # Nomi già presenti in output, letti una volta sola
+    taken = {}
+    for folder in (output_photo, output_video):
+        folder.mkdir(parents=True, exist_ok=True)
+        taken[folder] = {os.path.normcase(n) for n in os.listdir(folder)}
 
-    logging.info(f"Trovati {len(all_files)} file. Inizio estrazione...")
+    progress = tqdm(unit="file")
+    local = threading.local()
 
-    for file in tqdm(all_files):
+    def copy(file, dst_folder, dest_path, media):
+        # Hash calcolato durante la copia: il successivo cache_builder non rilegge i file.
+        # Ogni thread ha la sua connessione (sqlite3 non condivide le connessioni tra thread).
+        if hash_on_copy and not hasattr(local, "conn"):
+            local.conn = open_index()
         try:
-            if is_media_file(file, photo_ext):
-                copy_file(file, output_photo)
-            elif is_media_file(file, video_ext):
-                copy_file(file, output_video)
+            copy_file(file, dst_folder, getattr(local, "conn", None), media, algo, placement, dest_path)
         except Exception as e:
             logging.error(f"Errore su {file}: {e}")
+        progress.update(1)
+
+    def close_conn():
+        if hasattr(local, "conn"):
+            local.conn.close()
+
+    # Un gruppo di thread per disco sorgente (DeviceScheduler): la visita non corre
+    # troppo avanti rispetto alle copie
+    found = 0
+    batch = []
+    with DeviceScheduler(copy, concurrency, on_exit=close_conn) as scheduler:
+        for file, st_dev, st_ino in metrics.timed_iter(walk_media(src_path, photo_ext | video_ext)):
+            if is_media_file(file, photo_ext):
+                dst_folder, media = output_photo, "foto"
+            else:
+                dst_folder, media = output_video, "video"
+            batch.append((file, st_dev, st_ino, dst_folder, reserve_name(file, dst_folder, taken[dst_folder]), media))
+            found += 1
+            if len(batch) >= INODE_BATCH:
+                scheduler.submit(batch)
+                batch = []
+        scheduler.submit(batch)
+    progress.close()
+
+    logging.info(f"Trovati {found} file multimediali in {source}.")
 
 if __name__ == "__main__":
     setup_logger()
-    scan_and_copy()
+    config = load_config()
+    metrics.start_run("extract_media", config)
+    scan_and_copy(config)
@@ -0,0 +1,50 @@
+import time
+import numpy as np
+import face_recognition
+from decode import LATO_CLIP, decodifica_ridotta, preprocessa_clip
+
+def scala_box(volti, scala: float):
+    """Riporta i box (top, right, bottom, left) alle dimensioni dell'immagine originale."""
+    if scala == 1.0:
+        return volti
+    return [tuple(round(c * scala) for c in box) for box in volti]
+
+def volti_in_immagine(immagine, scala: float, max_lato: int = 1024, upsampling: int = 1):
+    """Box dei volti in un'immagine già decodificata (``scala`` = originale / decodificata).
+
+    Una sola passata con ``upsampling`` ingrandimenti: 1 è il default di
+    face_recognition; 0 è molto più veloce ma perde i volti piccoli (sotto gli
+    80 pixel circa nell'immagine ridotta a ``max_lato``).
+    """
+    if max_lato and max(immagine.size) > max_lato:
+        riduzione = max(immagine.size) / max_lato
+        immagine = immagine.resize((max(1, round(immagine.width / riduzione)),
+                                    max(1, round(immagine.height / riduzione))))
+        scala *= riduzione
+    volti = face_recognition.face_locations(np.asarray(immagine), number_of_times_to_upsample=upsampling)
+    return scala_box(volti, scala)
+
+def analizza_immagine(immagine_path, volti: bool = True, clip: bool = True,
+                      max_lato: int = 1024, upsampling: int = 1):
+    """Worker per il pool di processi: una sola decodifica per entrambi i rilevatori.
+
+    Restituisce (box dei volti o None se non richiesti, array preprocessato per CLIP
+    o None se non serve, errore, tempi in secondi di decodifica e rilevamento volti)
+    invece di sollevare eccezioni: i tempi misurati nel processo figlio tornano così
+    al processo principale, che li registra nelle metriche.
+    """
+    tempi = {}
+    try:
+        inizio = time.perf_counter()
+        immagine, scala = decodifica_ridotta(immagine_path, max_lato if volti else 0, LATO_CLIP if clip else 0)
+        tempi["decodifica"] = time.perf_counter() - inizio
+        if volti:
+            inizio = time.perf_counter()
+            box = volti_in_immagine(immagine, scala, max_lato, upsampling)
+            tempi["volti"] = time.perf_counter() - inizio
+        else:
+            box = None
+        per_clip = preprocessa_clip(immagine) if clip and not box else None
+        return box, per_clip, None, tempi
+    except Exception as e:
+        return None, None, str(e), tempi
@@ -0,0 +1,244 @@
+import os
+import sys
+import time
+import logging
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+import metrics
+from hashing import DEFAULT_ALGORITHM, new_hasher
+from hash_index import iter_hashed_files
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Byte per digest: sha256 e blake3 (blake2b ne usa 64, xxh3_128 16)
+DIGEST_SIZE = 32
+# Righe aggiunte dopo build_keys cercate per scansione prima di riordinare tutto
+PENDING_ROWS = 1024
+
+def digest_size(algo: str = DEFAULT_ALGORITHM) -> int:
+    return new_hasher(algo).digest_size
+
+def sort_keys(keys: array):
+    """(chiavi ordinate, righe nello stesso ordine); con NumPy l'ordinamento è in C."""
+    if not keys:
+        return array(keys.typecode), array("I")
+    if np is not None:
+        values = np.frombuffer(keys, dtype=np.uint64 if keys.typecode == "Q" else np.int64)
+        order = np.argsort(values, kind="stable")
+        return array(keys.typecode, values[order].tobytes()), array("I", order.astype(np.uint32).tobytes())
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    return array(keys.typecode, [keys[i] for i in order]), array("I", order)
+
+class FileRecord:
+    """Un file dell'indice: creato solo quando una ricerca lo restituisce."""
+    __slots__ = ("root", "dir", "name", "size", "digest")
+
+    def __init__(self, root: Path, rel_dir: str, name: str, size: int, digest: bytes = None):
+        self.root = root
+        self.dir = rel_dir
+        self.name = name
+        self.size = size
+        self.digest = digest
+
+    @property
+    def path(self) -> Path:
+        return self.root / self.dir / self.name
+
+    @property
+    def hash(self) -> str:
+        return self.digest.hex() if self.digest else None
+
+    def __repr__(self):
+        return f"FileRecord({self.path}, {self.size}, {self.hash})"
+
+class FileIndex:
+    """Indice compatto dei file di una cartella di output.
+
+    I dati stanno in colonne: dimensioni in ``array('q')``, digest binari in un unico
+    ``bytearray`` (``digest_size`` byte per riga), cartelle salvate una volta sola e
+    richiamate per numero. Le ricerche per hash, per dimensione e per (nome, dimensione)
+    usano chiavi intere ordinate e bisect; le chiavi si costruiscono alla prima ricerca.
+    Le righe aggiunte dopo (conferme delle impronte) si cercano per scansione finché
+    sono poche, poi le chiavi si ricostruiscono: ricerche e raggruppamenti vedono
+    sempre tutte le righe.
+    Al posto di un Path e di una tupla per file servono poche decine di byte.
+    """
+    __slots__ = ("root", "digest_size", "dirs", "dir_ids", "rows_dir", "names", "sizes", "digests",
+                 "hashed", "keys", "keyed")
+
+    def __init__(self, root, digest_size: int = DIGEST_SIZE):
+        self.root = Path(root)
+        self.digest_size = digest_size
+        self.dirs = []        # cartelle relative, ognuna una volta sola
+        self.dir_ids = {}     # cartella -> posizione in dirs
+        self.rows_dir = array("I")
+        self.names = []
+        self.sizes = array("q")
+        self.digests = bytearray()  # zeri dove l'hash manca
+        self.hashed = bytearray()   # 1 se la riga ha il digest
+        self.keys = None
+        self.keyed = 0        # righe coperte dalle chiavi; le successive si scandiscono
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, h) -> bool:
+        return self.find_hash(h) is not None
+
+    def to_digest(self, h) -> bytes:
+        digest = bytes.fromhex(h) if isinstance(h, str) else bytes(h)
+        if len(digest) != self.digest_size:
+            raise ValueError(f"Digest di {len(digest)} byte in un indice da {self.digest_size}")
+        return digest
+
+    def add(self, rel_dir: str, name: str, size: int, h=None):
+        """Aggiunge un file; ``h`` è l'hash esadecimale (o i byte del digest), se noto."""
+        digest = self.to_digest(h) if h else None
+        dir_id = self.dir_ids.get(rel_dir)
+        if dir_id is None:
+            dir_id = self.dir_ids[rel_dir] = len(self.dirs)
+            self.dirs.append(sys.intern(rel_dir))
+        self.rows_dir.append(dir_id)
+        self.names.append(name)
+        self.sizes.append(size)
+        self.digests += digest or bytes(self.digest_size)
+        self.hashed.append(1 if digest else 0)
+
+    def digest_at(self, row: int) -> bytes:
+        if not self.hashed[row]:
+            return None
+        return bytes(self.digests[row * self.digest_size:(row + 1) * self.digest_size])
+
+    def record(self, row: int) -> FileRecord:
+        return FileRecord(self.root, self.dirs[self.rows_dir[row]], self.names[row], self.sizes[row],
+                          self.digest_at(row))
+
+    def build_keys(self):
+        # Hash: primi 8 byte del digest; (nome, dimensione): hash() di Python, stabile
+        # per tutta la vita del processo. Le collisioni si scartano confrontando la riga.
+        hash_rows = [row for row in range(len(self.names)) if self.hashed[row]]
+        prefixes = array("Q", [int.from_bytes(self.digests[row * self.digest_size:row * self.digest_size + 8], "big")
+                               for row in hash_rows])
+        prefixes, order = sort_keys(prefixes)
+        hash_order = array("I", [hash_rows[i] for i in order])
+        names = array("q", [hash((name.lower(), size)) for name, size in zip(self.names, self.sizes)])
+        self.keys = {
+            "hash": (prefixes, hash_order),
+            "size": sort_keys(self.sizes),
+            "name": sort_keys(names),
+        }
+        self.keyed = len(self.names)
+
+    def row_key(self, kind: str, row: int) -> int:
+        """La chiave di ``row`` come in build_keys (None per l'hash se la riga non ce l'ha)."""
+        if kind == "hash":
+            if not self.hashed[row]:
+                return None
+            return int.from_bytes(self.digests[row * self.digest_size:row * self.digest_size + 8], "big")
+        if kind == "size":
+            return self.sizes[row]
+        return hash((self.names[row].lower(), self.sizes[row]))
+
+    def rows(self, kind: str, key: int):
+        if self.keys is None or len(self.names) - self.keyed > PENDING_ROWS:
+            self.build_keys()
+        keys, order = self.keys[kind]
+        i = bisect_left(keys, key)
+        while i < len(keys) and keys[i] == key:
+            yield order[i]
+            i += 1
+        for row in range(self.keyed, len(self.names)):
+            if self.row_key(kind, row) == key:
+                yield row
+
+    def find_hash(self, h) -> FileRecord:
+        """Un file con questo hash, o None."""
+        digest = self.to_digest(h)
+        for row in self.rows("hash", int.from_bytes(digest[:8], "big")):
+            if self.digest_at(row) == digest:
+                return self.record(row)
+        return None
+
+    def find_name_size(self, name: str, size: int) -> FileRecord:
+        """Un file con lo stesso nome (maiuscole ignorate) e la stessa dimensione, o None."""
+        name = name.lower()
+        for row in self.rows("name", hash((name, size))):
+            if self.sizes[row] == size and self.names[row].lower() == name:
+                return self.record(row)
+        return None
+
+    def with_size(self, size: int) -> list:
+        return [self.record(row) for row in self.rows("size", size)]
+
+    def has_size(self, size: int) -> bool:
+        return next(self.rows("size", size), None) is not None
+
+    def hash_groups(self):
+        """Righe con lo stesso digest, un elenco per hash in ordine di digest.
+
+        Dentro ogni elenco le righe restano nell'ordine in cui sono state aggiunte.
+        """
+        if self.keys is None or self.keyed < len(self.names):
+            self.build_keys()
+        prefixes, order = self.keys["hash"]
+        i = 0
+        while i < len(prefixes):
+            j = i + 1
+            while j < len(prefixes) and prefixes[j] == prefixes[i]:
+                j += 1
+            groups = {}
+            for row in order[i:j]:
+                groups.setdefault(self.digest_at(row), []).append(row)
+            for digest in sorted(groups):
+                yield groups[digest]
+            i = j
+
+    def memory_bytes(self) -> int:
+        """Stima della memoria occupata da colonne e chiavi."""
+        total = sum(sys.getsizeof(column) for column in (self.rows_dir, self.sizes, self.digests, self.hashed))
+        total += sys.getsizeof(self.names) + sum(sys.getsizeof(name) for name in self.names)
+        total += sum(sys.getsizeof(d) for d in self.dirs)
+        for keys, order in (self.keys or {}).values():
+            total += sys.getsizeof(keys) + sys.getsizeof(order)
+        return total
+
+    @classmethod
+    def from_walk(cls, root, valid_exts, digest_size: int = DIGEST_SIZE) -> "FileIndex":
+        """Nome e dimensione dei file di ``root`` con le estensioni date, senza hash.
+
+        Una visita con os.scandir: la dimensione arriva dalla stessa voce di cartella,
+        senza creare un Path per file.
+        """
+        index = cls(root, digest_size)
+        exts = tuple(e.lower() for e in valid_exts)
+        start = time.perf_counter()
+        entries = 0
+        stack = [(str(root), "")]
+        while stack:
+            folder, rel_dir = stack.pop()
+            try:
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        entries += 1
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((entry.path, f"{rel_dir}/{entry.name}" if rel_dir else entry.name))
+                        elif entry.name.lower().endswith(exts) and entry.is_file():
+                            index.add(rel_dir, entry.name, entry.stat().st_size)
+            except OSError as e:
+                logging.warning(f"Impossibile leggere {folder}: {e}")
+        metrics.add_time("walk", time.perf_counter() - start)
+        metrics.inc("walk_entries", entries)
+        return index
+
+    @classmethod
+    def from_index(cls, conn, root, media: str, algo: str = DEFAULT_ALGORITHM) -> "FileIndex":
+        """I file di ``media`` con hash completo calcolato con ``algo`` nell'indice SQLite."""
+        index = cls(root, digest_size(algo))
+        for rel_dir, fname, size, h, _ in iter_hashed_files(conn, media, algo):
+            if h:
+                index.add(rel_dir, fname, size, h)
+        return index
@@ -1,11 +1,20 @@
+import os
 import logging
 import json
+from stat import S_ISREG
 from pathlib import Path
+from collections import defaultdict
 from tqdm import tqdm
-from hashlib import sha256
+import metrics
+from storage import STORAGE_CLASSES
+from io_scheduler import DeviceScheduler, configured_concurrency
+from file_index import FileIndex, digest_size
+from hashing import DEFAULT_ALGORITHM, hash_file, fingerprint_file, fingerprint_prefix
+from hashing import configure_io, configured_algorithm, configured_fingerprint
+from hash_index import INDEX_PATH, open_index, get_folder_mtime, folder_mtimes, iter_hashed_files
+from hash_index import get_source_hashes, save_source_hash, save_full_hash
 
 CONFIG_PATH = "config.json"
-CACHE_ROOT = Path("cache")
 
 # Logger setup
 def setup_logger():
@@ -22,67 +31,147 @@ def load_config(path=CONFIG_PATH):
     with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
 
-def index_name_size(folder: Path, valid_exts: set) -> dict:
-    index = {}
-    for file in folder.rglob("*"):
-        if file.is_file() and file.suffix.lower() in valid_exts:
-            key = (file.name.lower(), file.stat().st_size)
-            index[key] = file
-    return index
-
-def get_file_hash(path: Path, block_size: int = 65536) -> str:
-    sha = sha256()
-    with path.open('rb') as f:
-        for chunk in iter(lambda: f.read(block_size), b''):
-            sha.update(chunk)
-    return sha.hexdigest()
-
-def load_hash_cache_for_folder(output_root: Path, valid_exts: set) -> dict:
-    hashes = {}
-    for cache_file in (CACHE_ROOT / output_root.name).rglob("cache.json"):
-        rel = cache_file.parent.relative_to(CACHE_ROOT / output_root.name)
-        out_dir = output_root / rel
-        try:
-            data = json.loads(cache_file.read_text(encoding="utf-8"))
-        except Exception as e:
-            logging.warning(f"Could not read cache {cache_file}: {e}")
-            continue
+@metrics.timed("get_file_hash")
+def get_file_hash(path: Path, algo: str = DEFAULT_ALGORITHM) -> str:
+    return hash_file(path, algo)
+
+def load_hash_cache_for_folder(conn, output_root: Path, label: str, valid_exts: set,
+                               algo: str = DEFAULT_ALGORITHM, fp_prefix: str = None,
+                               existing: FileIndex = None, fp_min_size: int = 0):
+    """Hash dei file di output dall'indice: (FileIndex, {impronta: [file]}, dimensioni).
+
+    I file con un'impronta veloce che inizia per ``fp_prefix`` sono raccolti
+    per impronta (l'hash completo può mancare); le dimensioni sono quelle dei file
+    da ``fp_min_size`` byte in su confrontabili solo con l'hash completo.
+    Con ``existing`` (la visita dell'output) un file conta solo se è stato visto
+    con lo stesso nome e la stessa dimensione, senza uno stat per file.
+    """
+    hashes = FileIndex(output_root, digest_size(algo))
+    fingerprints = defaultdict(list)
+    hash_only_sizes = set()
+    cached_mtimes = folder_mtimes(conn, label)
+    outdated = set()
+    for rel_dir, folder_mtime in cached_mtimes.items():
+        out_dir = output_root / rel_dir
         if not out_dir.exists():
             logging.warning(f"Output subdir missing: {out_dir}, cache ignored.")
-            continue
-        folder_mtime_actual = out_dir.stat().st_mtime
-        if abs(folder_mtime_actual - data.get("folder_mtime", -1)) > 1:
+            outdated.add(rel_dir)
+        elif abs(out_dir.stat().st_mtime - folder_mtime) > 1:
             logging.warning(f"Cache outdated for {out_dir}")
+            outdated.add(rel_dir)
+    for rel_dir, fname, size, h, fp in iter_hashed_files(conn, label, algo):
+        if rel_dir in outdated or rel_dir not in cached_mtimes:
             continue
-        for fname, info in data.get("files", {}).items():
-            h = info.get("hash")
-            if h and fname.lower().endswith(tuple(valid_exts)):
-                file_path = out_dir / fname
-                if file_path.exists():
-                    hashes[h] = file_path
-    return hashes
-
-def verify_cache_mtime(output_folder: Path, cache_root: Path) -> bool:
-    cache_file = cache_root / "cache.json"
-    if not cache_file.exists():
-        logging.warning(f"Nessuna cache trovata in: {cache_file}")
-        return False
-    try:
-        with cache_file.open("r", encoding="utf-8") as f:
-            cache_data = json.load(f)
-    except Exception as e:
-        logging.error(f"Errore lettura cache: {e}")
-        return False
-    if "folder_mtime" not in cache_data:
-        logging.warning("Cache invalida: manca 'folder_mtime'")
+        if fname.lower().endswith(tuple(valid_exts)):
+            if existing is not None:
+                present = existing.find_name_size(fname, size) is not None
+            else:
+                present = (output_root / rel_dir / fname).exists()
+            if present:
+                if h:
+                    hashes.add(rel_dir, fname, size, h)
+                if fp and fp_prefix and fp.startswith(fp_prefix):
+                    fingerprints[fp].append({"dir": rel_dir, "name": fname, "size": size,
+                                             "path": output_root / rel_dir / fname, "hash": h})
+                elif h and size >= fp_min_size:
+                    hash_only_sizes.add(size)
+    return hashes, fingerprints, hash_only_sizes
+
+def confirm_fingerprint_matches(conn, label: str, matches: list, hash_index: FileIndex, algo: str = DEFAULT_ALGORITHM) -> int:
+    """Calcola l'hash completo dei file di output con impronta uguale a una sorgente.
+
+    Gli hash sono aggiunti a ``hash_index`` e salvati nell'indice, così ogni file
+    di output viene letto per intero al massimo una volta. Restituisce quanti.
+    """
+    computed = 0
+    for match in matches:
+        if match["hash"]:
+            continue
+        try:
+            match["hash"] = get_file_hash(match["path"], algo)
+        except Exception as e:
+            logging.warning(f"Errore hashing {match['path']}: {e}")
+            continue
+        save_full_hash(conn, label, match["dir"], match["name"], match["hash"])
+        hash_index.add(match["dir"], match["name"], match["size"], match["hash"])
+        computed += 1
+    return computed
+
+def verify_cache_mtime(output_folder: Path, conn, label: str) -> bool:
+    folder_mtime_cached = get_folder_mtime(conn, label)
+    if folder_mtime_cached is None:
+        logging.warning(f"Nessuna cache trovata per '{label}' in: {INDEX_PATH}")
         return False
     folder_mtime = output_folder.stat().st_mtime
-    if abs(cache_data["folder_mtime"] - folder_mtime) > 1:
+    if abs(folder_mtime_cached - folder_mtime) > 1:
         logging.warning("⚠️ La cartella di output è stata modificata dopo la creazione della cache.")
         return False
     return True
 
-def find_missing(sources, output_folder, valid_exts, missing_file, label, tolerance, mode):
+def walk_sources(sources, valid_exts: set) -> list:
+    """[(file, stat)] per ogni sorgente, nello stesso ordine di ``sources``.
+
+    Le sorgenti su dischi diversi vengono visitate in parallelo, quelle sullo
+    stesso disco una dopo l'altra.
+    """
+    valid_exts = {e.lower() for e in valid_exts}
+    found = {}
+
+    def walk(src, index):
+        files = []
+        for file in metrics.timed_iter(Path(src).rglob("*")):
+            if file.suffix.lower() not in valid_exts:
+                continue
+            try:
+                stat = file.stat()
+            except OSError as e:
+                logging.warning(f"Impossibile leggere {file}: {e}")
+                continue
+            if S_ISREG(stat.st_mode):
+                files.append((file, stat))
+        found[index] = files
+        logging.info(f"Scanned source: {src} ({len(files)} file)")
+
+    with DeviceScheduler(walk, dict.fromkeys(STORAGE_CLASSES, 1), queue_size=0, quiet=True) as scheduler:
+        scheduler.submit([(src, os.stat(src).st_dev, i, i) for i, src in enumerate(sources)])
+    return [found.get(i, []) for i in range(len(sources))]
+
+def read_source(file: Path, size: int, h: str, fp: str, algo: str, fingerprint, fingerprints: dict,
+                hash_only_sizes: set):
+    """Letture necessarie per confrontare per hash un file sorgente: (hash, impronta, esito).
+
+    L'esito è "unique" se l'impronta veloce basta a dire che nessun output è uguale,
+    "error" se il file non si legge, altrimenti "ok". Non tocca l'indice: può girare
+    nei thread di DeviceScheduler.
+    """
+    if fingerprint and size >= fingerprint["min_size"]:
+        # Prima l'impronta a campioni: se nessun output ha la stessa il file
+        # manca di sicuro e non serve leggerlo per intero
+        if not (fp or "").startswith(fingerprint_prefix(fingerprint)):
+            try:
+                fp = fingerprint_file(file, fingerprint["samples"], fingerprint["sample_bytes"], algo)
+            except Exception as e:
+                logging.warning(f"Errore impronta {file}: {e}")
+                return h, None, "error"
+        if fp not in fingerprints and size not in hash_only_sizes:
+            return h, fp, "unique"
+    if not h:
+        try:
+            h = get_file_hash(file, algo)
+        except Exception as e:
+            logging.warning(f"Errore hashing {file}: {e}")
+            return None, fp, "error"
+    return h, fp, "ok"
+
+def find_missing(sources, output_folder, valid_exts, missing_file, label, tolerance, mode,
+                 algo=DEFAULT_ALGORITHM, fingerprint=None, concurrency=None, confirm=None):
+    """Scrive in ``missing_file`` i file delle sorgenti che mancano in ``output_folder``.
+
+    Sorgenti e letture per l'hash sono distribuite per disco con DeviceScheduler
+    (``concurrency`` letture contemporanee per classe di disco). Se la cache è
+    superata ``confirm(domanda)`` decide se continuare per nome e dimensione
+    (di default lo si chiede all'utente).
+    """
     out_folder = Path(output_folder)
     if not out_folder.exists():
         logging.error(f"La cartella di output non esiste: {out_folder}")
@@ -93,61 +182,116 @@ def find_missing(sources, output_folder, valid_exts, missing_file, label, tolera
             logging.error(f"La cartella di origine non esiste: {src}")
             return
 
-    cache_path = Path(f"cache/{label}/cache.json")
-    if mode == 'hash' and not verify_cache_mtime(out_folder, cache_path.parent):
+    conn = open_index()
+    if mode == 'hash' and not verify_cache_mtime(out_folder, conn, label):
         logging.warning(f"⚠️ Cache non valida o outdated per '{label}'.")
-        choice = input("Procedere con la ricerca usando solo nome e dimensione? (s/n): ").strip().lower()
-        if choice != 's':
+        question = "Procedere con la ricerca usando solo nome e dimensione? (s/n): "
+        if not (confirm(question) if confirm else input(question).strip().lower() == 's'):
             logging.info("Operazione annullata dall'utente.")
+            conn.close()
             return
         mode = 'name'
 
     logging.info(f"\n=== Analisi '{label}' (mode={mode}) ===")
-    name_index = index_name_size(out_folder, valid_exts)
-    hash_index = {}
+    name_index = FileIndex.from_walk(out_folder, valid_exts)
+    hash_index = FileIndex(out_folder, digest_size(algo))
+    fingerprints, hash_only_sizes = {}, set()
 
     if mode == 'hash':
-        hash_index = load_hash_cache_for_folder(out_folder, valid_exts)
-        logging.info(f"Loaded {len(hash_index)} hashes from cache for {label}")
+        hash_index, fingerprints, hash_only_sizes = load_hash_cache_for_folder(
+            conn, out_folder, label, valid_exts, algo, fingerprint and fingerprint_prefix(fingerprint),
+            name_index, fingerprint["min_size"] if fingerprint else 0)
+        logging.info(f"Loaded {len(hash_index)} hashes and {len(fingerprints)} fingerprints from cache for {label}")
 
+    skipped_by_size = 0
+    skipped_by_fingerprint = 0
+    confirmed_outputs = 0
+    cached_hashes = 0
+
+    # (posizione nella visita, name, size, path): l'elenco resta nell'ordine delle sorgenti
     missing = []
-    for src in sources:
-        src_folder = Path(src)
-        logging.info(f"Scanning source: {src_folder}")
-        for file in tqdm(src_folder.rglob("*"), desc=f"{label} -> {src_folder}"):
-            if not file.is_file() or file.suffix.lower() not in valid_exts:
-                continue
+    to_read = []
+    position = 0
+    for files in walk_sources(sources, valid_exts):
+        for file, stat in files:
+            position += 1
             name = file.name
-            size = file.stat().st_size
-            key = (name.lower(), size)
-            if key in name_index:
+            size = stat.st_size
+            metrics.inc("source_files")
+            if name_index.find_name_size(name, size) is not None:
+                metrics.inc("name_size_matches")
                 continue
-            if mode == 'hash':
-                try:
-                    h = get_file_hash(file)
-                except Exception as e:
-                    logging.warning(f"Errore hashing {file}: {e}")
-                    missing.append((name, size, str(file)))
-                    continue
-                if h in hash_index:
-                    continue
-            missing.append((name, size, str(file)))
+            if mode != 'hash':
+                missing.append((position, name, size, str(file)))
+            elif not name_index.has_size(size):
+                # Nessun match per hash è possibile se nessun file di output ha la stessa dimensione
+                skipped_by_size += 1
+                missing.append((position, name, size, str(file)))
+            else:
+                h, fp = get_source_hashes(conn, file, size, stat.st_mtime, algo)
+                to_read.append((position, file, stat, h, fp))
+
+    # Hash e impronte delle sorgenti: dischi diversi in parallelo, ognuno in ordine di inode
+    results = {}
+    with tqdm(total=len(to_read), desc=f"{label} -> hash sorgenti", unit="file") as bar:
+        def read(file, position, size, h, fp):
+            results[position] = read_source(file, size, h, fp, algo, fingerprint, fingerprints, hash_only_sizes)
+            bar.update(1)
+
+        with DeviceScheduler(read, concurrency, queue_size=0) as scheduler:
+            scheduler.submit([(file, stat.st_dev, stat.st_ino, position, stat.st_size, h, fp)
+                              for position, file, stat, h, fp in to_read])
+
+    for position, file, stat, cached_h, _ in to_read:
+        name, size = file.name, stat.st_size
+        h, fp, status = results.get(position, (None, None, "error"))
+        if status == "error":
+            missing.append((position, name, size, str(file)))
+            continue
+        save_source_hash(conn, file, size, stat.st_mtime, h, algo, fp)
+        if status == "unique":
+            skipped_by_fingerprint += 1
+            missing.append((position, name, size, str(file)))
+            continue
+        if cached_h:
+            cached_hashes += 1
+            metrics.inc("source_hash_hits")
+        else:
+            metrics.inc("source_hash_misses")
+        if fingerprint and size >= fingerprint["min_size"] and h not in hash_index:
+            confirmed_outputs += confirm_fingerprint_matches(
+                conn, label, fingerprints.get(fp, []), hash_index, algo)
+        if h not in hash_index:
+            missing.append((position, name, size, str(file)))
+    conn.commit()
+    conn.close()
+    missing = [entry[1:] for entry in sorted(missing)]
 
     Path(missing_file).parent.mkdir(parents=True, exist_ok=True)
     with open(missing_file, 'w', encoding='utf-8') as f:
         for name, size, path in missing:
             f.write(f"{name},{size},{path}\n")
 
+    metrics.inc("missing_files", len(missing))
+    metrics.inc("skipped_by_size", skipped_by_size)
+    metrics.inc("skipped_by_fingerprint", skipped_by_fingerprint)
     logging.info(f"{label}: totali output = {len(name_index)} / hash disponibili = {len(hash_index)} / file mancanti = {len(missing)}")
+    logging.info(f"{label}: memoria indici output = "
+                 f"{(name_index.memory_bytes() + hash_index.memory_bytes()) / 1024 ** 2:.1f} MB")
+    if mode == 'hash':
+        logging.info(f"{label}: hash evitati per dimensione = {skipped_by_size} / hash sorgente da cache = {cached_hashes}")
+        if fingerprint:
+            logging.info(f"{label}: hash evitati per impronta = {skipped_by_fingerprint} / "
+                         f"output confermati con hash completo = {confirmed_outputs}")
     logging.info(f"Report saved to: {missing_file}")
 
-def main():
-    setup_logger()
-    cfg = load_config()
-    print("1: name+size, 2: name+size+hash fallback")
-    m = input("Choose mode (1/2): ").strip()
-    mode = 'name' if m == '1' else 'hash'
+def find_all_missing(cfg: dict, mode: str, confirm=None):
+    """Elenchi dei file mancanti per foto e video (mode "name" o "hash")."""
     tol = cfg['media'].get('size_tolerance_bytes', 0)
+    algo = configured_algorithm(cfg)
+    configure_io(cfg)
+    fingerprint = configured_fingerprint(cfg)
+    concurrency = configured_concurrency(cfg)
 
     find_missing(
         sources=cfg['sources'].get('altre_foto', []),
@@ -156,7 +300,11 @@ def main():
         missing_file=cfg['missing_lists']['foto'],
         label='foto',
         tolerance=tol,
-        mode=mode
+        mode=mode,
+        algo=algo,
+        fingerprint=fingerprint,
+        concurrency=concurrency,
+        confirm=confirm
     )
 
     find_missing(
@@ -166,8 +314,20 @@ def main():
         missing_file=cfg['missing_lists']['video'],
         label='video',
         tolerance=tol,
-        mode=mode
+        mode=mode,
+        algo=algo,
+        fingerprint=fingerprint,
+        concurrency=concurrency,
+        confirm=confirm
     )
 
+def main():
+    setup_logger()
+    cfg = load_config()
+    metrics.start_run("find_missing", cfg)
+    print("1: name+size, 2: name+size+hash fallback")
+    m = input("Choose mode (1/2): ").strip()
+    find_all_missing(cfg, 'name' if m == '1' else 'hash')
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,282 @@
+import json
+import logging
+import sqlite3
+from pathlib import Path
+
+INDEX_PATH = Path("cache/index.sqlite")
+CACHE_ROOT = Path("cache")
+# Algoritmo di tutti gli hash scritti prima che fosse configurabile
+LEGACY_ALGORITHM = "sha256"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    media TEXT NOT NULL,
+    dir   TEXT NOT NULL,
+    name  TEXT NOT NULL,
+    size  INTEGER,
+    mtime REAL,
+    hash  TEXT,
+    partial TEXT,
+    algo  TEXT DEFAULT 'sha256',
+    phash TEXT,
+    fingerprint TEXT,
+    PRIMARY KEY (media, dir, name)
+);
+CREATE INDEX IF NOT EXISTS idx_files_size ON files (size);
+CREATE INDEX IF NOT EXISTS idx_files_hash ON files (hash);
+CREATE INDEX IF NOT EXISTS idx_files_name_size ON files (name COLLATE NOCASE, size);
+
+CREATE TABLE IF NOT EXISTS folders (
+    media        TEXT NOT NULL,
+    dir          TEXT NOT NULL,
+    folder_mtime REAL,
+    entries      INTEGER,
+    subdirs      INTEGER,
+    PRIMARY KEY (media, dir)
+);
+
+-- Hash dei file nelle sorgenti secondarie (find_missing), validi finché size/mtime non cambiano
+CREATE TABLE IF NOT EXISTS sources (
+    path  TEXT PRIMARY KEY,
+    size  INTEGER,
+    mtime REAL,
+    hash  TEXT,
+    algo  TEXT DEFAULT 'sha256',
+    fingerprint TEXT
+);
+
+-- Risultati di organise.py per contenuto: rilevamento volti, riga dell'embedding
+-- CLIP in cache/clip_embeddings.f16 e categoria finale
+CREATE TABLE IF NOT EXISTS images (
+    hash     TEXT PRIMARY KEY,
+    faces    INTEGER,
+    emb_row  INTEGER,
+    category TEXT,
+    label    TEXT,
+    conf     REAL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Colonne aggiunte dopo la prima versione dello schema
+MIGRATED_COLUMNS = {
+    "files": {"partial": "TEXT", "algo": "TEXT DEFAULT 'sha256'", "phash": "TEXT", "fingerprint": "TEXT"},
+    "sources": {"algo": "TEXT DEFAULT 'sha256'", "fingerprint": "TEXT"},
+    "folders": {"entries": "INTEGER", "subdirs": "INTEGER"},
+}
+
+# Indici su colonne migrate: vanno creati dopo ensure_columns
+MIGRATED_INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_files_fingerprint ON files (fingerprint);
+"""
+
+def ensure_columns(conn):
+    for table, columns in MIGRATED_COLUMNS.items():
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for column, kind in columns.items():
+            if column not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+
+def open_index(path=INDEX_PATH) -> sqlite3.Connection:
+    """Apre (o crea) l'indice SQLite condiviso da tutti gli script."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    ensure_columns(conn)
+    conn.executescript(MIGRATED_INDEXES)
+    return conn
+
+def compact_index(conn):
+    """Riporta il WAL nel file principale e lo svuota (a fine build, o dopo un crash)."""
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+def dir_key(rel: Path) -> str:
+    """Chiave della cartella relativa alla radice di output ("" per la radice)."""
+    rel = Path(rel)
+    return "" if rel == Path(".") else rel.as_posix()
+
+def load_folder(conn, media: str, rel_dir: str) -> dict:
+    """Restituisce {nome: {"hash", "mtime", "size", ...}} come nel vecchio cache.json."""
+    rows = conn.execute(
+        "SELECT name, hash, mtime, size, partial, algo, phash, fingerprint FROM files"
+        " WHERE media = ? AND dir = ?",
+        (media, rel_dir),
+    )
+    return {
+        name: {"hash": h, "mtime": mtime, "size": size, "partial": partial, "algo": algo, "phash": phash,
+               "fingerprint": fp}
+        for name, h, mtime, size, partial, algo, phash, fp in rows
+    }
+
+def load_media(conn, media: str) -> dict:
+    """Come load_folder ma per tutte le cartelle: {(dir, nome): info}."""
+    rows = conn.execute(
+        "SELECT dir, name, hash, mtime, size, partial, algo, phash, fingerprint FROM files WHERE media = ?",
+        (media,)
+    )
+    return {
+        (rel_dir, name): {"hash": h, "mtime": mtime, "size": size, "partial": partial, "algo": algo,
+                          "phash": phash, "fingerprint": fp}
+        for rel_dir, name, h, mtime, size, partial, algo, phash, fp in rows
+    }
+
+def save_files(conn, media: str, rel_dir: str, entries: dict):
+    conn.executemany(
+        "INSERT OR REPLACE INTO files (media, dir, name, size, mtime, hash, partial, algo, phash, fingerprint)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [(media, rel_dir, name, info.get("size"), info.get("mtime"), info.get("hash"),
+          info.get("partial"), info.get("algo") or LEGACY_ALGORITHM, info.get("phash"), info.get("fingerprint"))
+         for name, info in entries.items()],
+    )
+
+def save_full_hash(conn, media: str, rel_dir: str, name: str, h: str):
+    """Aggiunge l'hash completo a un file indicizzato solo con l'impronta veloce."""
+    conn.execute(
+        "UPDATE files SET hash = ? WHERE media = ? AND dir = ? AND name = ?", (h, media, rel_dir, name)
+    )
+
+def save_phashes(conn, media: str, rows):
+    """Salva l'hash percettivo (near_duplicates) per righe (dir, name, phash) già presenti."""
+    conn.executemany(
+        "UPDATE files SET phash = ? WHERE media = ? AND dir = ? AND name = ?",
+        [(phash, media, rel_dir, name) for rel_dir, name, phash in rows],
+    )
+
+def record_file(conn, media: str, output_root: Path, file_path: Path, h: str, algo: str = LEGACY_ALGORITHM):
+    """Registra un file appena scritto in output con l'hash già calcolato."""
+    file_path = Path(file_path)
+    stat = file_path.stat()
+    rel_dir = dir_key(file_path.parent.relative_to(output_root))
+    save_files(conn, media, rel_dir, {
+        file_path.name: {"hash": h, "mtime": stat.st_mtime, "size": stat.st_size, "algo": algo}
+    })
+
+def delete_files(conn, media: str, rel_dir: str, names):
+    """Toglie dall'indice i file non più presenti nella cartella."""
+    conn.executemany(
+        "DELETE FROM files WHERE media = ? AND dir = ? AND name = ?",
+        [(media, rel_dir, name) for name in names],
+    )
+
+def drop_folder(conn, media: str, rel_dir: str):
+    """Toglie dall'indice una cartella scomparsa con tutte le sue sottocartelle."""
+    pattern = rel_dir.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "/%"
+    for table in ("files", "folders"):
+        conn.execute(
+            f"DELETE FROM {table} WHERE media = ? AND (dir = ? OR dir LIKE ? ESCAPE '\\')",
+            (media, rel_dir, pattern),
+        )
+
+def set_folder_mtime(conn, media: str, rel_dir: str, folder_mtime: float, entries: int = None,
+                     subdirs: int = None):
+    conn.execute(
+        "INSERT OR REPLACE INTO folders (media, dir, folder_mtime, entries, subdirs) VALUES (?, ?, ?, ?, ?)",
+        (media, rel_dir, folder_mtime, entries, subdirs),
+    )
+
+def get_folder_mtime(conn, media: str, rel_dir: str = ""):
+    row = conn.execute(
+        "SELECT folder_mtime FROM folders WHERE media = ? AND dir = ?", (media, rel_dir)
+    ).fetchone()
+    return row[0] if row else None
+
+def folder_mtimes(conn, media: str) -> dict:
+    return dict(conn.execute("SELECT dir, folder_mtime FROM folders WHERE media = ?", (media,)))
+
+def folder_states(conn, media: str) -> dict:
+    """{dir: (folder_mtime, file indicizzati, sottocartelle)} per tutte le cartelle note."""
+    return {
+        rel_dir: (folder_mtime, entries, subdirs)
+        for rel_dir, folder_mtime, entries, subdirs in conn.execute(
+            "SELECT dir, folder_mtime, entries, subdirs FROM folders WHERE media = ?", (media,)
+        )
+    }
+
+def iter_hashed_files(conn, media: str, algo: str = LEGACY_ALGORITHM):
+    """Restituisce (dir, name, size, hash, fingerprint) per i file di un media con hash
+    o impronta veloce calcolati con ``algo``."""
+    return conn.execute(
+        "SELECT dir, name, size, hash, fingerprint FROM files"
+        " WHERE media = ? AND (hash IS NOT NULL OR fingerprint IS NOT NULL) AND algo = ? ORDER BY dir, name",
+        (media, algo),
+    )
+
+def get_source_hash(conn, path, size: int, mtime: float, algo: str = LEGACY_ALGORITHM):
+    """Hash già calcolato per un file sorgente, se size, mtime e algoritmo non sono cambiati."""
+    return get_source_hashes(conn, path, size, mtime, algo)[0]
+
+def get_source_hashes(conn, path, size: int, mtime: float, algo: str = LEGACY_ALGORITHM):
+    """(hash, impronta veloce) già calcolati per un file sorgente; None dove mancano."""
+    row = conn.execute(
+        "SELECT hash, fingerprint FROM sources WHERE path = ? AND size = ? AND mtime = ? AND algo = ?",
+        (str(path), size, mtime, algo),
+    ).fetchone()
+    return tuple(row) if row else (None, None)
+
+def save_source_hash(conn, path, size: int, mtime: float, h: str, algo: str = LEGACY_ALGORITHM,
+                     fingerprint: str = None):
+    conn.execute(
+        "INSERT OR REPLACE INTO sources (path, size, mtime, hash, algo, fingerprint) VALUES (?, ?, ?, ?, ?, ?)",
+        (str(path), size, mtime, h, algo, fingerprint),
+    )
+
+IMAGE_COLUMNS = ("faces", "emb_row", "category", "label", "conf")
+
+def load_images(conn, hashes) -> dict:
+    """Risultati di organise già salvati: {hash: {"faces", "emb_row", ...}}."""
+    found = {}
+    hashes = list(hashes)
+    for i in range(0, len(hashes), 500):
+        chunk = hashes[i:i + 500]
+        rows = conn.execute(
+            f"SELECT hash, {', '.join(IMAGE_COLUMNS)} FROM images"
+            f" WHERE hash IN ({', '.join('?' * len(chunk))})",
+            chunk,
+        )
+        for h, *values in rows:
+            found[h] = dict(zip(IMAGE_COLUMNS, values))
+    return found
+
+def set_image(conn, h: str, **values):
+    columns = [c for c in IMAGE_COLUMNS if c in values]
+    conn.execute(
+        f"INSERT INTO images (hash, {', '.join(columns)}) VALUES (?{', ?' * len(columns)})"
+        f" ON CONFLICT(hash) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in columns)}",
+        [h] + [values[c] for c in columns],
+    )
+
+def migrate_json_cache(conn, cache_root: Path = CACHE_ROOT) -> int:
+    """Importa una sola volta i vecchi cache.json per cartella nell'indice."""
+    if conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone():
+        return 0
+    imported = 0
+    for cache_file in sorted(cache_root.glob("*/**/cache.json")):
+        rel = cache_file.parent.relative_to(cache_root)
+        media, rel_dir = rel.parts[0], dir_key(Path(*rel.parts[1:]))
+        try:
+            data = json.loads(cache_file.read_text(encoding="utf-8"))
+        except Exception as e:
+            logging.warning(f"Errore nel parsing di {cache_file}: {e}")
+            continue
+        files = data.get("files", {})
+        save_files(conn, media, rel_dir, files)
+        if "folder_mtime" in data:
+            set_folder_mtime(conn, media, rel_dir, data["folder_mtime"])
+        imported += len(files)
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', '1')")
+    conn.commit()
+    if imported:
+        logging.info(f"📦 Migrati {imported} record dai cache.json in {INDEX_PATH}")
+    return imported
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    with open_index() as conn:
+        migrate_json_cache(conn)
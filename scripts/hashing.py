@@ -0,0 +1,190 @@
+import os
+import hashlib
+import shutil
+import time
+import threading
+from pathlib import Path
+import metrics
+from storage import STORAGE_CLASSES, configure_storage, storage_class
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+DEFAULT_ALGORITHM = "sha256"
+BLOCK_SIZE = 1024 * 1024
+
+# Blocco di lettura per classe di disco e soglia oltre la quale si usa mmap;
+# sovrascritti da configure_io con la sezione "hashing" di config.json
+BLOCK_SIZES = {"hdd": 8 * BLOCK_SIZE, "ssd": BLOCK_SIZE, "nvme": 4 * BLOCK_SIZE}
+MMAP_THRESHOLD = 64 * BLOCK_SIZE
+
+# Un buffer di lettura per thread, riusato per tutti i file
+_buffers = threading.local()
+
+# xxh3_128 non è crittografico: va bene solo per la deduplicazione
+ALGORITHMS = ("sha256", "blake2b", "blake3", "xxh3_128")
+
+def new_hasher(algo: str = DEFAULT_ALGORITHM):
+    if algo == "sha256":
+        return hashlib.sha256()
+    if algo == "blake2b":
+        return hashlib.blake2b()
+    if algo == "blake3":
+        if blake3 is None:
+            raise ImportError("Algoritmo 'blake3' richiede il pacchetto blake3 (pip install blake3)")
+        return blake3.blake3()
+    if algo == "xxh3_128":
+        if xxhash is None:
+            raise ImportError("Algoritmo 'xxh3_128' richiede il pacchetto xxhash (pip install xxhash)")
+        return xxhash.xxh3_128()
+    raise ValueError(f"Algoritmo di hash non supportato: {algo} (validi: {', '.join(ALGORITHMS)})")
+
+def read_buffer(size: int) -> bytearray:
+    buf = getattr(_buffers, "buf", None)
+    if buf is None or len(buf) != size:
+        buf = _buffers.buf = bytearray(size)
+    return buf
+
+def advise_sequential(fd: int):
+    """Avvisa il kernel che il file sarà letto una volta, dall'inizio alla fine."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_NOREUSE)
+    except OSError:
+        pass
+
+def block_size_for(path: Path, st_dev: int = None) -> int:
+    return BLOCK_SIZES.get(storage_class(path, st_dev), BLOCK_SIZE)
+
+def hash_file(path: Path, algo: str = DEFAULT_ALGORITHM, block_size: int = None) -> str:
+    """Unica funzione di hashing del contenuto usata da tutti gli script.
+
+    Legge con readinto in un buffer riusato (nessuna allocazione per blocco) o,
+    per i file da MMAP_THRESHOLD byte in su, dalla mappatura in memoria.
+    ``block_size`` di default dipende dalla classe del disco (BLOCK_SIZES).
+    Il tempo di lettura e quello di hashing finiscono in metriche separate; con mmap
+    la lettura avviene nei page fault durante l'hashing e non si può separare.
+    """
+    h = new_hasher(algo)
+    read_time = 0.0
+    start = time.perf_counter()
+    with open(path, "rb", buffering=0) as f:
+        stat = os.fstat(f.fileno())
+        block_size = block_size or block_size_for(path, stat.st_dev)
+        advise_sequential(f.fileno())
+        if mmap is not None and stat.st_size >= MMAP_THRESHOLD:
+            metrics.inc("hash_mmap_files")
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                view = memoryview(mm)
+                try:
+                    for offset in range(0, stat.st_size, block_size):
+                        h.update(view[offset:offset + block_size])
+                finally:
+                    view.release()
+        else:
+            buf = read_buffer(block_size)
+            view = memoryview(buf)
+            while True:
+                read_start = time.perf_counter()
+                n = f.readinto(buf)
+                read_time += time.perf_counter() - read_start
+                if not n:
+                    break
+                h.update(view[:n])
+    metrics.inc("hash_bytes", stat.st_size)
+    metrics.add_time("hash_read", read_time)
+    metrics.add_time("hash_update", time.perf_counter() - start - read_time)
+    return h.hexdigest()
+
+def copy_and_hash(src: Path, dest: Path, algo: str = DEFAULT_ALGORITHM, block_size: int = None) -> str:
+    """Copia ``src`` in ``dest`` come shutil.copy2, calcolando l'hash nello stesso passaggio."""
+    h = new_hasher(algo)
+    with open(src, "rb", buffering=0) as fsrc, open(dest, "wb", buffering=0) as fdst:
+        buf = read_buffer(block_size or block_size_for(src, os.fstat(fsrc.fileno()).st_dev))
+        view = memoryview(buf)
+        advise_sequential(fsrc.fileno())
+        while True:
+            n = fsrc.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+            written = 0
+            while written < n:
+                written += fdst.write(view[written:n])
+            metrics.inc("hash_bytes", n)
+    shutil.copystat(src, dest)
+    return h.hexdigest()
+
+def fingerprint_file(path: Path, samples: int = 8, sample_bytes: int = BLOCK_SIZE,
+                     algo: str = DEFAULT_ALGORITHM) -> str:
+    """Impronta veloce: dimensione più l'hash di ``samples`` blocchi a offset fissi.
+
+    Impronte diverse garantiscono file diversi; se coincidono serve l'hash completo
+    per confermare. I parametri fanno parte dell'impronta, così cambiarli la invalida.
+    """
+    samples = max(2, samples)
+    h = new_hasher(algo)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        h.update(size.to_bytes(8, "little"))
+        if size <= samples * sample_bytes:
+            for chunk in iter(lambda: f.read(sample_bytes), b""):
+                h.update(chunk)
+        else:
+            # Primo e ultimo blocco compresi, gli altri equidistanti
+            for i in range(samples):
+                f.seek((size - sample_bytes) * i // (samples - 1))
+                h.update(f.read(sample_bytes))
+    return f"{samples}x{sample_bytes}:{h.hexdigest()}"
+
+def configured_fingerprint(cfg: dict):
+    """Parametri dell'impronta veloce per i file grandi, o None se disattivata."""
+    fp_cfg = cfg.get("fingerprint", {})
+    if not fp_cfg.get("enabled", False):
+        return None
+    return {
+        "min_size": fp_cfg.get("min_size", 64 * 1024 * 1024),
+        "samples": max(2, fp_cfg.get("samples", 8)),
+        "sample_bytes": fp_cfg.get("sample_bytes", BLOCK_SIZE),
+    }
+
+def fingerprint_prefix(fingerprint: dict) -> str:
+    """Inizio comune alle impronte calcolate con questi parametri."""
+    return f"{fingerprint['samples']}x{fingerprint['sample_bytes']}:"
+
+def configure_io(cfg: dict):
+    """Applica blocchi per classe di disco, soglia mmap e classi di storage da config.json.
+
+    Le impostazioni valgono solo per il processo che la chiama: i pool di processi
+    la ricevono come ``initializer`` (cache_builder.make_executor).
+    """
+    global MMAP_THRESHOLD
+    hashing_cfg = cfg.get("hashing", {})
+    for kind, size in hashing_cfg.get("block_sizes", {}).items():
+        if kind not in STORAGE_CLASSES:
+            raise ValueError(f"Classe di storage non supportata: {kind} (valide: {', '.join(STORAGE_CLASSES)})")
+        BLOCK_SIZES[kind] = size
+    MMAP_THRESHOLD = hashing_cfg.get("mmap_threshold", MMAP_THRESHOLD)
+    configure_storage(cfg)
+
+def configured_algorithm(cfg: dict) -> str:
+    """Algoritmo di hash configurato; le impostazioni di I/O sono a parte (configure_io)."""
+    algo = cfg.get("hashing", {}).get("algorithm", DEFAULT_ALGORITHM)
+    new_hasher(algo)  # errore subito se l'algoritmo non è disponibile
+    return algo
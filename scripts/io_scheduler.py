@@ -0,0 +1,109 @@
+import os
+import queue
+import logging
+import threading
+from storage import STORAGE_CLASSES, storage_class
+
+# Letture contemporanee per disco: su un disco rotativo ogni lettura in più è un seek in più
+DEFAULT_CONCURRENCY = {"hdd": 1, "ssd": 4, "nvme": 8}
+QUEUE_SIZE = 1000
+
+def configured_concurrency(cfg: dict) -> dict:
+    """Letture contemporanee per classe di disco, da ``storage.concurrency`` di config.json."""
+    concurrency = dict(DEFAULT_CONCURRENCY)
+    for kind, workers in cfg.get("storage", {}).get("concurrency", {}).items():
+        if kind not in STORAGE_CLASSES:
+            raise ValueError(f"Classe di storage non supportata: {kind} (valide: {', '.join(STORAGE_CLASSES)})")
+        concurrency[kind] = max(1, workers)
+    return concurrency
+
+def device_name(st_dev: int) -> str:
+    try:
+        return f"{os.major(st_dev)}:{os.minor(st_dev)}"
+    except AttributeError:  # Windows: st_dev è il numero di serie del volume
+        return str(st_dev)
+
+class DeviceScheduler:
+    """Esegue ``func(path, *args)`` raggruppando i lavori per disco (``st_dev``).
+
+    Ogni disco ha la sua coda e i suoi thread: dischi diversi lavorano in parallelo,
+    sullo stesso disco girano al massimo ``concurrency[classe]`` lavori insieme (uno
+    sui dischi rotativi). I lavori di ogni blocco passato a submit partono in ordine
+    di inode, che sui dischi rotativi segue in genere la posizione dei dati.
+    Con ``queue_size`` > 0 submit si blocca quando un disco è troppo indietro;
+    con 0 le code non hanno limite e un disco lento non ferma gli altri.
+    Uscendo dal ``with`` per un'eccezione (anche Ctrl+C) i lavori ancora in coda
+    vengono scartati: si attendono solo quelli già partiti.
+    """
+
+    def __init__(self, func, concurrency: dict = None, queue_size: int = QUEUE_SIZE, on_exit=None,
+                 quiet: bool = False):
+        self.func = func
+        self.quiet = quiet
+        self.on_exit = on_exit  # chiamata da ogni thread prima di terminare (risorse per thread)
+        self.concurrency = concurrency or DEFAULT_CONCURRENCY
+        self.queue_size = queue_size
+        self.queues = {}  # st_dev -> (coda, numero di thread)
+        self.threads = []
+        self.cancelled = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(cancel=exc_type is not None)
+
+    def device_queue(self, path, st_dev: int) -> queue.Queue:
+        if st_dev not in self.queues:
+            kind = storage_class(path, st_dev)
+            workers = max(1, self.concurrency.get(kind, 1))
+            jobs = queue.Queue(maxsize=self.queue_size)
+            self.queues[st_dev] = (jobs, workers)
+            for _ in range(workers):
+                thread = threading.Thread(target=self.worker, args=(jobs,), daemon=True)
+                thread.start()
+                self.threads.append(thread)
+            if not self.quiet:
+                logging.info(f"💽 Disco {device_name(st_dev)} ({kind}): {workers} letture in parallelo")
+        return self.queues[st_dev][0]
+
+    def submit(self, jobs):
+        """Accoda i lavori ``(path, st_dev, st_ino, *args)``, ognuno sul suo disco in ordine di inode."""
+        for job in sorted(jobs, key=lambda job: (job[1], job[2])):
+            self.device_queue(job[0], job[1]).put(job)
+
+    def worker(self, jobs: queue.Queue):
+        while True:
+            job = jobs.get()
+            if job is None:
+                if self.on_exit:
+                    self.on_exit()
+                return
+            if self.cancelled.is_set():
+                continue
+            try:
+                self.func(job[0], *job[3:])
+            except Exception as e:
+                logging.error(f"Errore su {job[0]}: {e}")
+
+    def close(self, cancel: bool = False):
+        """Attende la fine di tutti i lavori accodati; con ``cancel`` solo di quelli già partiti."""
+        if cancel:
+            self.cancelled.set()
+            dropped = 0
+            for jobs, _ in self.queues.values():
+                while True:
+                    try:
+                        jobs.get_nowait()
+                    except queue.Empty:
+                        break
+                    dropped += 1
+            if dropped and not self.quiet:
+                logging.warning(f"⏹️ Interrotto: {dropped} lavori in coda annullati")
+        for jobs, workers in self.queues.values():
+            for _ in range(workers):
+                jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.queues.clear()
+        self.threads.clear()
@@ -0,0 +1,280 @@
+import os
+import sys
+import json
+import time
+import atexit
+import signal
+import shutil
+import logging
+import threading
+import subprocess
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Prefisso dei nomi delle metriche nel textfile Prometheus
+PREFIX = "photo_scaffolding"
+REPORT_DIR = Path("logs/metriche")
+PROFILERS = ("cprofile", "py-spy")
+
+# Limiti dei bucket (secondi) per le durate: da mezzo millisecondo a un minuto
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Con "metrics.enabled": false contatori e timer non registrano nulla
+ENABLED = True
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum", "min", "max")
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def cumulative(self):
+        """(limite, osservazioni <= limite) come nei bucket Prometheus, +Inf compreso."""
+        total = 0
+        for le, n in zip(self.buckets + (float("inf"),), self.counts):
+            total += n
+            yield le, total
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "buckets": {("+Inf" if le == float("inf") else str(le)): n for le, n in self.cumulative()},
+        }
+
+class Registry:
+    """Contatori e istogrammi di un processo, aggiornabili da più thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+
+    def inc(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name: str, value: float, buckets=DURATION_BUCKETS):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+REGISTRY = Registry()
+
+# Esecuzione in corso (start_run): fase, destinazioni dei report, profiler attivo
+_run = {}
+
+def inc(name: str, value: float = 1):
+    if ENABLED:
+        REGISTRY.inc(name, value)
+
+def observe(name: str, value: float, buckets=DURATION_BUCKETS):
+    if ENABLED:
+        REGISTRY.observe(name, value, buckets)
+
+def add_time(name: str, seconds: float):
+    """Somma ``seconds`` al contatore ``{name}_seconds`` (tempo totale, senza distribuzione)."""
+    inc(f"{name}_seconds", seconds)
+
+@contextmanager
+def timer(name: str):
+    """Durata del blocco nell'istogramma ``{name}_seconds``."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(f"{name}_seconds", time.perf_counter() - start)
+
+def timed(name: str):
+    """Decoratore: durata di ogni chiamata nell'istogramma ``{name}_seconds``."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def timed_iter(iterable, name: str = "walk"):
+    """Itera su ``iterable`` sommando in ``{name}_seconds`` solo il tempo speso a produrre
+    gli elementi (non quello di chi li consuma) e contandoli in ``{name}_entries``."""
+    it = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(it)
+        except StopIteration:
+            add_time(name, time.perf_counter() - start)
+            return
+        add_time(name, time.perf_counter() - start)
+        inc(f"{name}_entries")
+        yield item
+
+def peak_rss() -> int:
+    """Picco di memoria residente del processo in byte (None dove non disponibile)."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024  # KB su Linux, byte su macOS
+
+def hit_rates(counters: dict) -> dict:
+    """{base: hits / (hits + misses)} per ogni coppia di contatori ``base_hits``/``base_misses``."""
+    rates = {}
+    for name in counters:
+        for suffix in ("_hits", "_misses"):
+            if name.endswith(suffix):
+                base = name[:-len(suffix)]
+                hits, misses = counters.get(f"{base}_hits", 0), counters.get(f"{base}_misses", 0)
+                if hits + misses:
+                    rates[base] = hits / (hits + misses)
+    return rates
+
+def report(stage: str) -> dict:
+    """Report JSON dell'esecuzione: contatori, istogrammi e tassi di hit della cache."""
+    with REGISTRY.lock:
+        counters = dict(sorted(REGISTRY.counters.items()))
+        histograms = {name: h.summary() for name, h in sorted(REGISTRY.histograms.items())}
+    started = _run.get("started", time.time())
+    return {
+        "stage": stage,
+        "started": datetime.fromtimestamp(started).isoformat(timespec="seconds"),
+        "seconds": time.time() - started,
+        "peak_rss_bytes": peak_rss(),
+        "counters": counters,
+        "hit_rates": hit_rates(counters),
+        "histograms": histograms,
+    }
+
+def prometheus_text(data: dict) -> str:
+    """Il report nel formato del textfile collector di node_exporter."""
+    label = f'stage="{data["stage"]}"'
+    lines = []
+
+    def gauge(name, value):
+        if value is not None:
+            lines.append(f"# TYPE {PREFIX}_{name} gauge")
+            lines.append(f"{PREFIX}_{name}{{{label}}} {value}")
+
+    gauge("run_duration_seconds", data["seconds"])
+    gauge("last_run_timestamp_seconds", time.time())
+    gauge("peak_rss_bytes", data["peak_rss_bytes"])
+    for name, value in data["counters"].items():
+        lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+        lines.append(f"{PREFIX}_{name}_total{{{label}}} {value}")
+    for name, h in data["histograms"].items():
+        lines.append(f"# TYPE {PREFIX}_{name} histogram")
+        for le, n in h["buckets"].items():
+            lines.append(f'{PREFIX}_{name}_bucket{{{label},le="{le}"}} {n}')
+        lines.append(f"{PREFIX}_{name}_sum{{{label}}} {h['sum']}")
+        lines.append(f"{PREFIX}_{name}_count{{{label}}} {h['count']}")
+    return "\n".join(lines) + "\n"
+
+def write_atomic(path: Path, text: str):
+    # node_exporter può leggere il file in qualsiasi momento: mai un file a metà
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(text, encoding="utf-8")
+    os.replace(tmp, path)
+
+def write_reports():
+    """Scrive ``{stage}.json`` e ``{stage}.prom`` con i valori raccolti finora."""
+    if not _run:
+        return
+    data = report(_run["stage"])
+    for folder in (_run["report_dir"], _run["prometheus_dir"]):
+        folder.mkdir(parents=True, exist_ok=True)
+    write_atomic(_run["report_dir"] / f"{_run['stage']}.json", json.dumps(data, indent=2))
+    write_atomic(_run["prometheus_dir"] / f"{_run['stage']}.prom", prometheus_text(data))
+
+def start_profiler(kind: str, output: Path):
+    """cProfile (file .prof per pstats/snakeviz) o py-spy (campionamento esterno, formato speedscope)."""
+    if kind == "cprofile":
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    exe = shutil.which("py-spy")
+    if exe is None:
+        logging.warning("Profilazione py-spy richiesta ma py-spy non è installato (pip install py-spy)")
+        return None
+    return subprocess.Popen(
+        [exe, "record", "--pid", str(os.getpid()), "--subprocesses", "--format", "speedscope",
+         "--output", str(output)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+def stop_profiler(profiler, output: Path):
+    if isinstance(profiler, subprocess.Popen):
+        # py-spy scrive il profilo quando riceve SIGINT
+        try:
+            profiler.send_signal(signal.SIGINT)
+        except (ValueError, OSError):
+            profiler.terminate()
+        profiler.wait(timeout=60)
+    else:
+        profiler.disable()
+        profiler.dump_stats(output)
+    logging.info(f"🔬 Profilo salvato in {output}")
+
+def start_run(stage: str, cfg: dict):
+    """Inizio dell'esecuzione di uno script: legge la sezione "metrics" e avvia il profiler.
+
+    I report vengono scritti a fine processo (anche dopo un errore) da finish_run.
+    I processi figli dei pool non riportano i propri valori al processo principale.
+    """
+    global ENABLED
+    metrics_cfg = cfg.get("metrics", {})
+    ENABLED = metrics_cfg.get("enabled", True)
+    if not ENABLED:
+        return
+    profile = metrics_cfg.get("profile") or None
+    if profile and profile not in PROFILERS:
+        raise ValueError(f"Profiler non supportato: {profile} (validi: {', '.join(PROFILERS)})")
+    report_dir = Path(metrics_cfg.get("report_dir") or REPORT_DIR)
+    _run.update(
+        stage=stage,
+        pid=os.getpid(),
+        started=time.time(),
+        report_dir=report_dir,
+        prometheus_dir=Path(metrics_cfg.get("prometheus_dir") or report_dir),
+        profile_path=report_dir / (f"{stage}.prof" if profile == "cprofile" else f"{stage}.speedscope.json"),
+    )
+    if profile:
+        report_dir.mkdir(parents=True, exist_ok=True)
+        _run["profiler"] = start_profiler(profile, _run["profile_path"])
+    atexit.register(finish_run)
+
+def finish_run():
+    # I processi figli creati con fork ereditano _run: solo chi l'ha avviata scrive i report
+    if not _run or _run["pid"] != os.getpid():
+        return
+    if _run.get("profiler") is not None:
+        stop_profiler(_run["profiler"], _run["profile_path"])
+    write_reports()
+    logging.info(f"📈 Metriche salvate in {_run['report_dir'] / (_run['stage'] + '.json')}")
+    _run.clear()
@@ -0,0 +1,203 @@
+import json
+import logging
+from pathlib import Path
+from collections import defaultdict
+from itertools import combinations
+from tqdm import tqdm
+from PIL import Image
+import metrics
+from hash_index import open_index, load_media, save_phashes
+from cache_builder import make_executor
+from decode import decodifica_ridotta
+
+CONFIG_PATH = "config.json"
+REPORT_PATH = Path("logs/quasi_duplicati.txt")
+
+# dHash a 64 bit diviso in 4 blocchi da 16 bit per il multi-index hashing
+HASH_BITS = 64
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+def setup_logger():
+    logs_dir = Path("logs")
+    logs_dir.mkdir(exist_ok=True)
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[logging.FileHandler(logs_dir / "near_duplicates.log", encoding='utf-8'), logging.StreamHandler()]
+    )
+
+def load_config():
+    with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def dhash(file_path) -> str:
+    """Difference hash: confronta i pixel adiacenti di una miniatura 9x8 in scala di grigi.
+
+    Resiste a ricompressione, ridimensionamento e cambio di formato; l'immagine
+    viene raddrizzata secondo l'EXIF così JPEG ruotati e export HEIC coincidono.
+    """
+    immagine, _ = decodifica_ridotta(file_path, 0, 64, orienta=True)
+    pixel = list(immagine.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    valore = 0
+    for riga in range(8):
+        for colonna in range(8):
+            valore = (valore << 1) | (pixel[riga * 9 + colonna] > pixel[riga * 9 + colonna + 1])
+    return f"{valore:016x}"
+
+@metrics.timed("compute_phash")
+def compute_phash(file_path):
+    try:
+        return dhash(file_path)
+    except Exception as e:
+        logging.warning(f"Errore hash percettivo {file_path}: {e}")
+        return None
+
+def load_phashes(conn, output_root: Path, valid_exts: set, media: str = "foto", executor=None) -> list:
+    """(path, size, phash) per le foto indicizzate, calcolando solo gli hash percettivi mancanti.
+
+    Vengono considerati i file già aggiornati da cache_builder (stesso mtime); gli
+    hash calcolati sono salvati nell'indice accanto a quello del contenuto.
+    """
+    found, to_hash = [], []
+    for (rel_dir, name), info in sorted(load_media(conn, media).items()):
+        path = output_root / rel_dir / name
+        if path.suffix.lower() not in valid_exts:
+            continue
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        if stat.st_mtime != info["mtime"]:
+            continue
+        if info.get("phash"):
+            found.append((path, stat.st_size, info["phash"]))
+        else:
+            to_hash.append((rel_dir, name, path, stat.st_size))
+
+    from_cache = len(found)
+    paths = [path for _, _, path, _ in to_hash]
+    phashes = executor.map(compute_phash, paths, chunksize=16) if executor else map(compute_phash, paths)
+    computed = []
+    for (rel_dir, name, path, size), phash in tqdm(zip(to_hash, phashes), total=len(to_hash),
+                                                   desc="Hash percettivi", unit="file"):
+        if phash:
+            found.append((path, size, phash))
+            computed.append((rel_dir, name, phash))
+        if len(computed) >= 500:
+            save_phashes(conn, media, computed)
+            conn.commit()
+            computed.clear()
+    save_phashes(conn, media, computed)
+    conn.commit()
+    metrics.inc("phash_hits", from_cache)
+    metrics.inc("phash_misses", len(to_hash))
+    logging.info(f"Hash percettivi calcolati: {len(found) - from_cache}, da cache: {from_cache}")
+    return found
+
+if hasattr(int, "bit_count"):  # Python 3.10+
+    def distanza(a: int, b: int) -> int:
+        return (a ^ b).bit_count()
+else:
+    def distanza(a: int, b: int) -> int:
+        return bin(a ^ b).count("1")
+
+def maschere(raggio: int) -> list:
+    """Maschere XOR che generano tutti i blocchi a distanza di Hamming <= ``raggio``."""
+    return [sum(1 << p for p in posizioni)
+            for r in range(raggio + 1) for posizioni in combinations(range(CHUNK_BITS), r)]
+
+def gruppi_simili(valori: list, soglia: int) -> list:
+    """Raggruppa gli hash a distanza <= ``soglia`` senza confrontare tutte le coppie.
+
+    Multi-index hashing: se due hash distano al più ``soglia`` bit, almeno uno dei
+    CHUNKS blocchi differisce al più di ``soglia // CHUNKS`` bit. Ogni hash cerca
+    quindi nelle tabelle dei blocchi solo le varianti entro quel raggio, e i pochi
+    candidati trovati si verificano sull'hash intero. Restituisce liste di indici.
+    """
+    tabelle = [{} for _ in range(CHUNKS)]
+    genitore = list(range(len(valori)))
+
+    def radice(i):
+        while genitore[i] != i:
+            genitore[i] = genitore[genitore[i]]
+            i = genitore[i]
+        return i
+
+    # Ogni hash cerca tra quelli già inseriti, poi si aggiunge: ogni coppia è vista una volta
+    xor = maschere(soglia // CHUNKS)
+    for i, v in enumerate(tqdm(valori, desc="Ricerca quasi duplicati", unit="hash")):
+        blocchi = [(v >> (c * CHUNK_BITS)) & CHUNK_MASK for c in range(CHUNKS)]
+        candidati = set()
+        for tabella, blocco in zip(tabelle, blocchi):
+            for m in xor:
+                trovati = tabella.get(blocco ^ m)
+                if trovati:
+                    candidati.update(trovati)
+        for j in candidati:
+            if distanza(v, valori[j]) <= soglia:
+                genitore[radice(j)] = radice(i)
+        for tabella, blocco in zip(tabelle, blocchi):
+            tabella.setdefault(blocco, []).append(i)
+
+    gruppi = defaultdict(list)
+    for i in range(len(valori)):
+        gruppi[radice(i)].append(i)
+    return [g for g in gruppi.values() if len(g) > 1]
+
+def find_near_duplicates(cfg: dict = None):
+    cfg = cfg or load_config()
+    dedup_cfg = cfg.get("dedup", {})
+    soglia = dedup_cfg.get("near_threshold", 6)
+    output_root = Path(cfg["output"]["foto"])
+    valid_exts = set(e.lower() for e in cfg["media"]["photo_extensions"])
+    cache_cfg = cfg.get("cache", {})
+    executor = make_executor(cache_cfg.get("workers", 1), cache_cfg.get("executor", "thread"), cfg)
+
+    conn = open_index()
+    files = load_phashes(conn, output_root, valid_exts, executor=executor)
+    conn.close()
+    if executor:
+        executor.shutdown()
+
+    # Hash identici collassano in un solo valore: si cerca solo tra i valori distinti
+    per_valore = defaultdict(list)
+    for path, size, phash in files:
+        per_valore[int(phash, 16)].append((path, size))
+    valori = sorted(per_valore)
+    with metrics.timer("near_grouping"):
+        gruppi = [[valori[i] for i in g] for g in gruppi_simili(valori, soglia)]
+    # Gruppi di soli hash identici (stesso dHash, file diversi)
+    raggruppati = {v for g in gruppi for v in g}
+    gruppi += [[v] for v in valori if len(per_valore[v]) > 1 and v not in raggruppati]
+
+    report = []
+    total_files = 0
+    for gruppo in gruppi:
+        membri = sorted(((path, size, v) for v in gruppo for path, size in per_valore[v]),
+                        key=lambda m: (-m[1], str(m[0])))
+        keep_path, keep_size, keep_value = membri[0]
+        report.append((keep_path, keep_size, [(path, distanza(keep_value, v)) for path, _, v in membri[1:]]))
+        total_files += len(membri)
+    report.sort(key=lambda r: str(r[0]))
+
+    REPORT_PATH.parent.mkdir(exist_ok=True, parents=True)
+    with REPORT_PATH.open("w", encoding="utf-8") as f:
+        for keep_path, keep_size, similar in report:
+            f.write(f"{keep_path} | {keep_size / 1024:.0f} KB\n")
+            for path, d in similar:
+                f.write(f"    ≈ {path} (distanza {d})\n")
+        f.write(f"\n🖼️ Gruppi di quasi duplicati: {len(report)}\n")
+        f.write(f"📁 File coinvolti: {total_files}\n")
+        f.write(f"======================================================\n")
+
+    logging.info(f"🖼️ Gruppi di quasi duplicati: {len(report)} (soglia {soglia} bit)")
+    logging.info(f"📁 File coinvolti: {total_files}")
+    logging.info(f"📄 Report salvato in: {REPORT_PATH}")
+
+if __name__ == "__main__":
+    setup_logger()
+    cfg = load_config()
+    metrics.start_run("near_duplicates", cfg)
+    find_near_duplicates(cfg)
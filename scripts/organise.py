@@ -1,13 +1,21 @@
 import os
 import json
-import shutil
+import time
 import logging
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 from tqdm import tqdm
-from PIL import Image
-import torch
-import clip
-import face_recognition
+from placement import place_file
+from hashing import hash_file, configure_io, configured_algorithm
+from hash_index import open_index, load_folder, record_file, load_images, set_image
+import metrics
+
+# numpy, torch, clip e face_recognition si importano nelle funzioni che li usano:
+# importare il modulo non carica nessun modello, CLIP si carica solo se c'è
+# un'immagine da codificare o da etichettare
 
 # === Logger setup ===
 LOG_FILE = Path("log/organizza_foto.log")
@@ -23,25 +31,42 @@ def setup_logger():
         ]
     )
 
-setup_logger()
-
 # === Caricamento configurazione ===
-with open("config.json", "r", encoding="utf-8") as f:
-    config = json.load(f)
+def load_config():
+    with open("config.json", "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def configura(cfg: dict):
+    """Imposta cartelle e parametri del modulo dalla configurazione e crea le destinazioni."""
+    global config, foto_dir, dest_persone, dest_animali, dest_varie, placement, batch_size
+    global face_workers, face_max_edge, face_upsample, clip_backend, clip_threads, estensioni_valide
+    config = cfg
+    foto_dir = config["output"]["foto"]
+    output_base = os.path.join("output", "organizzate")
+    dest_persone = os.path.join(output_base, "Persone")
+    dest_animali = os.path.join(output_base, "Panorami_Animali")
+    dest_varie = os.path.join(output_base, "Varie")
+
+    os.makedirs(dest_persone, exist_ok=True)
+    os.makedirs(dest_animali, exist_ok=True)
+    os.makedirs(dest_varie, exist_ok=True)
 
-foto_dir = config["output"]["foto"]
-output_base = os.path.join("output", "organizzate")
-dest_persone = os.path.join(output_base, "Persone")
-dest_animali = os.path.join(output_base, "Panorami_Animali")
-dest_varie = os.path.join(output_base, "Varie")
+    placement = config.get("copy", {}).get("placement", "copy")
 
-os.makedirs(dest_persone, exist_ok=True)
-os.makedirs(dest_animali, exist_ok=True)
-os.makedirs(dest_varie, exist_ok=True)
+    organise_cfg = config.get("organise", {})
+    batch_size = max(1, organise_cfg.get("batch_size", 32))
+    face_workers = max(1, organise_cfg.get("face_workers", os.cpu_count() or 1))
+    face_max_edge = organise_cfg.get("face_max_edge", 1024)
+    face_upsample = organise_cfg.get("face_upsample", 1)
+    clip_backend = organise_cfg.get("clip_backend", "torch")
+    clip_threads = organise_cfg.get("clip_threads", 0)
+    estensioni_valide = tuple(config["media"]["photo_extensions"])
 
-# === Caricamento modello CLIP ===
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load("ViT-B/32", device=device)
+# Modello CLIP e feature delle etichette: caricati da carica_modello alla prima immagine che li richiede
+model = encode_image = device = text_features = None
+
+# Embedding scritti su disco (e poi etichettati) a blocchi di questa dimensione
+EMBEDDING_FLUSH = 256
 
 etichette = [
     "una persona",
@@ -53,51 +78,234 @@ etichette = [
     "una schermata",
     "una foto generica"
 ]
-etichette_tokenizzate = clip.tokenize(etichette).to(device)
 
 # === Funzioni ===
-estensioni_valide = tuple(config["media"]["photo_extensions"])
+def carica_modello():
+    """Carica CLIP (una volta sola) e calcola le feature delle etichette, che non cambiano."""
+    global model, encode_image, device, text_features
+    if model is not None:
+        return
+    import torch
+    import clip
+    from clip_backend import carica_clip
+    model, _, encode_image, device = carica_clip(clip_backend, clip_threads)
+    etichette_tokenizzate = clip.tokenize(etichette).to(device)
+    with torch.no_grad():
+        text_features = model.encode_text(etichette_tokenizzate)
+        text_features /= text_features.norm(dim=-1, keepdim=True)
 
-def classifica_clip(immagine_path):
-    try:
-        image = preprocess(Image.open(immagine_path).convert("RGB")).unsqueeze(0).to(device)
-        with torch.no_grad():
-            image_features = model.encode_image(image)
-            logits_per_image, _ = model(image, etichette_tokenizzate)
-            probs = logits_per_image.softmax(dim=-1).cpu().numpy().flatten()
-        return etichette[probs.argmax()], probs.max()
-    except Exception as e:
-        logging.warning(f"Errore nella classificazione di {immagine_path}: {e}")
-        return None, 0.0
+@metrics.timed("codifica_batch")
+def codifica_batch(tensori):
+    """Embedding CLIP normalizzati (float32, su CPU) di un batch di immagini già preprocessate nel pool."""
+    import numpy as np
+    import torch
+    inizio = time.perf_counter()
+    with torch.no_grad():
+        image_features = encode_image(torch.from_numpy(np.stack(tensori)).to(device)).float()
+    vettori = (image_features / image_features.norm(dim=-1, keepdim=True)).cpu().numpy()
+    # Tempo CLIP per immagine, confrontabile con quello dei volti
+    per_immagine = (time.perf_counter() - inizio) / len(tensori)
+    for _ in tensori:
+        metrics.observe("clip_encode_seconds", per_immagine)
+    return vettori
 
-def contiene_volti(immagine_path):
-    try:
-        immagine = face_recognition.load_image_file(immagine_path)
-        volti = face_recognition.face_locations(immagine)
-        return len(volti) > 0
-    except Exception as e:
-        logging.warning(f"Errore nel rilevamento volti in {immagine_path}: {e}")
-        return False
-
-# === Analisi immagini ===
-immagini = [f for f in os.listdir(foto_dir) if f.lower().endswith(estensioni_valide)]
-
-for nome_file in tqdm(immagini, desc="Organizzazione immagini"):
-    sorgente = os.path.join(foto_dir, nome_file)
-
-    if contiene_volti(sorgente):
-        destinazione = os.path.join(dest_persone, nome_file)
-        logging.info(f"{nome_file} → Persone (volto rilevato)")
-    else:
-        etichetta, conf = classifica_clip(sorgente)
-        if etichetta in ["un panorama", "un animale"]:
-            destinazione = os.path.join(dest_animali, nome_file)
-            logging.info(f"{nome_file} → Panorami_Animali ({etichetta} - conf {conf:.2f})")
-        else:
-            destinazione = os.path.join(dest_varie, nome_file)
-            logging.info(f"{nome_file} → Varie ({etichetta} - conf {conf:.2f})")
+@metrics.timed("etichette_da_embedding")
+def etichette_da_embedding(vettori):
+    """(etichetta, conf) per embedding già calcolati: basta un prodotto con le feature del testo."""
+    import numpy as np
+    import torch
+    with torch.no_grad():
+        image_features = torch.from_numpy(np.asarray(vettori, dtype=np.float32)).to(device)
+        logits = model.logit_scale.exp().float() * image_features @ text_features.float().t()
+        probs = logits.softmax(dim=-1).cpu().numpy()
+    return [(etichette[p.argmax()], float(p.max())) for p in probs]
+
+def analizza_batch(percorsi, richieste):
+    """Decodifica ogni file una sola volta nel pool di processi, per volti e CLIP insieme.
+
+    ``richieste`` indica per ogni percorso (servono i volti, serve CLIP); i risultati di
+    analizza_immagine tornano nello stesso ordine. I lavori in anticipo sono limitati,
+    così gli array preprocessati in attesa di CLIP non riempiono la memoria.
+    ``analizza_batch_seconds`` misura l'attesa del processo principale per ogni risultato.
+    """
+    from faces import analizza_immagine
+    analizza = partial(analizza_immagine, max_lato=face_max_edge, upsampling=face_upsample)
+    with ProcessPoolExecutor(max_workers=face_workers) as pool:
+        lavori = iter(zip(percorsi, richieste))
+        anticipo = max(2 * batch_size, 4 * face_workers)
+        in_corso = deque(pool.submit(analizza, p, *r) for p, r in islice(lavori, anticipo))
+        while in_corso:
+            with metrics.timer("analizza_batch"):
+                risultato = in_corso.popleft().result()
+            prossimo = next(lavori, None)
+            if prossimo is not None:
+                percorso, richiesta = prossimo
+                in_corso.append(pool.submit(analizza, percorso, *richiesta))
+            yield risultato
 
+def hash_immagini(conn, immagini, algo):
+    """Hash di ogni immagine: dall'indice di cache_builder se aggiornato, altrimenti calcolato."""
+    cached = load_folder(conn, "foto", "")
+    hashes = {}
+    for nome_file in tqdm(immagini, desc="Hash immagini"):
+        sorgente = Path(foto_dir) / nome_file
+        entry = cached.get(nome_file)
+        if (entry and entry["hash"] and entry["algo"] == algo
+                and entry["mtime"] == sorgente.stat().st_mtime):
+            hashes[nome_file] = entry["hash"]
+            metrics.inc("index_hits")
+            continue
+        metrics.inc("index_misses")
+        try:
+            h = hash_file(sorgente, algo)
+        except Exception as e:
+            logging.warning(f"Errore hashing {sorgente}: {e}")
+            continue
+        record_file(conn, "foto", Path(foto_dir), sorgente, h, algo)
+        hashes[nome_file] = h
+    conn.commit()
+    return hashes
+
+@metrics.timed("copy_file")
+def copia(sorgente, destinazione):
     try:
-        shutil.copy2(sorgente, destinazione)
+        place_file(sorgente, destinazione, placement)
     except Exception as e:
         logging.warning(f"Errore nella copia di {sorgente} → {destinazione}: {e}")
+
+def main(cfg: dict = None):
+    """Organizza le foto di ``output.foto`` in Persone, Panorami_Animali e Varie."""
+    configura(cfg or load_config())
+
+    # === Analisi immagini ===
+    immagini = [f for f in os.listdir(foto_dir) if f.lower().endswith(estensioni_valide)]
+    if not immagini:
+        logging.info(f"Nessuna immagine da organizzare in {foto_dir}")
+        return
+    from embeddings import EMBEDDINGS_PATH, append_embeddings, load_embeddings
+
+    # Risultati salvati per contenuto: si analizza solo ciò che non è mai stato visto
+    configure_io(config)
+    conn = open_index()
+    hashes = hash_immagini(conn, immagini, configured_algorithm(config))
+    immagini = [nome_file for nome_file in immagini if nome_file in hashes]
+    noti = load_images(conn, set(hashes.values()))
+
+    # Righe oltre la fine del file degli embedding (cancellato o troncato): si ricalcolano
+    righe = len(load_embeddings())
+    perse = [h for h, risultato in noti.items()
+             if risultato.get("emb_row") is not None and risultato["emb_row"] >= righe]
+    for h in perse:
+        noti[h]["emb_row"] = None
+        set_image(conn, h, emb_row=None)
+    if perse:
+        conn.commit()
+        logging.warning(f"⚠️ {len(perse)} embedding mancanti in {EMBEDDINGS_PATH}: verranno ricalcolati")
+
+    def info(nome_file):
+        return noti.setdefault(hashes[nome_file], {})
+
+    def unici(nomi):
+        """Un file per contenuto: i duplicati condividono il risultato."""
+        visti = set()
+        risultato = []
+        for nome_file in nomi:
+            if hashes[nome_file] not in visti:
+                visti.add(hashes[nome_file])
+                risultato.append(nome_file)
+        return risultato
+
+    # Una sola decodifica per file: volti se mai rilevati, immagine per CLIP se manca l'embedding
+    da_analizzare = unici([n for n in immagini if info(n).get("faces") is None
+                           or (not info(n)["faces"] and info(n).get("emb_row") is None)])
+    richieste = [(info(n).get("faces") is None, info(n).get("emb_row") is None) for n in da_analizzare]
+    percorsi = [os.path.join(foto_dir, nome_file) for nome_file in da_analizzare]
+    nuovi_nomi, nuovi_vettori = [], []
+    batch_nomi, batch_tensori = [], []
+
+    def codifica_in_attesa():
+        nuovi_vettori.extend(codifica_batch(batch_tensori))
+        nuovi_nomi.extend(batch_nomi)
+        batch_nomi.clear()
+        batch_tensori.clear()
+
+    def salva_embedding():
+        prima_riga = append_embeddings(nuovi_vettori)
+        for i, nome_file in enumerate(nuovi_nomi):
+            info(nome_file)["emb_row"] = prima_riga + i
+            set_image(conn, hashes[nome_file], emb_row=prima_riga + i)
+        conn.commit()
+        nuovi_nomi.clear()
+        nuovi_vettori.clear()
+
+    metrics.inc("analysis_hits", len(unici(immagini)) - len(da_analizzare))
+    metrics.inc("analysis_misses", len(da_analizzare))
+    for nome_file, (volti, per_clip, errore, tempi) in tqdm(zip(da_analizzare, analizza_batch(percorsi, richieste)),
+                                                            total=len(da_analizzare), desc="Volti ed embedding CLIP"):
+        if errore:
+            # non salvato in cache: si riprova alla prossima esecuzione
+            logging.warning(f"Errore nell'analisi di {nome_file}: {errore}")
+            continue
+        metrics.observe("decode_seconds", tempi["decodifica"])
+        if "volti" in tempi:
+            metrics.observe("face_detection_seconds", tempi["volti"])
+        if volti is not None:
+            info(nome_file)["faces"] = int(len(volti) > 0)
+            set_image(conn, hashes[nome_file], faces=int(len(volti) > 0))
+        if per_clip is not None:
+            carica_modello()
+            batch_nomi.append(nome_file)
+            batch_tensori.append(per_clip)
+            if len(batch_tensori) == batch_size:
+                codifica_in_attesa()
+        if len(nuovi_vettori) >= EMBEDDING_FLUSH:
+            salva_embedding()
+    if batch_tensori:
+        codifica_in_attesa()
+    if nuovi_vettori:
+        salva_embedding()
+    conn.commit()
+
+    senza_volti = [n for n in immagini if not info(n).get("faces")]
+
+    # Etichette dagli embedding salvati: cambiare `etichette` non richiede nuova inferenza
+    embedding = load_embeddings()
+    con_embedding = [n for n in senza_volti if info(n).get("emb_row") is not None]
+    etichettati = {}
+    if con_embedding:
+        carica_modello()
+    for i in range(0, len(con_embedding), EMBEDDING_FLUSH):
+        blocco = con_embedding[i:i + EMBEDDING_FLUSH]
+        vettori = embedding[[info(n)["emb_row"] for n in blocco]]
+        etichettati.update(zip(blocco, etichette_da_embedding(vettori)))
+
+    for nome_file in tqdm(immagini, desc="Organizzazione immagini"):
+        sorgente = os.path.join(foto_dir, nome_file)
+
+        if info(nome_file).get("faces"):
+            categoria, etichetta, conf = "Persone", None, None
+            destinazione = os.path.join(dest_persone, nome_file)
+            logging.info(f"{nome_file} → Persone (volto rilevato)")
+        else:
+            etichetta, conf = etichettati.get(nome_file, (None, 0.0))
+            if etichetta in ["un panorama", "un animale"]:
+                categoria = "Panorami_Animali"
+                destinazione = os.path.join(dest_animali, nome_file)
+                logging.info(f"{nome_file} → Panorami_Animali ({etichetta} - conf {conf:.2f})")
+            else:
+                categoria = "Varie"
+                destinazione = os.path.join(dest_varie, nome_file)
+                logging.info(f"{nome_file} → Varie ({etichetta} - conf {conf:.2f})")
+
+        set_image(conn, hashes[nome_file], category=categoria, label=etichetta, conf=conf)
+        copia(sorgente, destinazione)
+
+    conn.commit()
+    conn.close()
+
+# Il pool di processi per i volti reimporta questo modulo: il lavoro vero va sotto __main__
+if __name__ == "__main__":
+    setup_logger()
+    cfg = load_config()
+    metrics.start_run("organise", cfg)
+    main(cfg)
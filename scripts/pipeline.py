@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import importlib.util
+from pathlib import Path
+import metrics
+
+CONFIG_PATH = "config.json"
+LOG_FILE = Path("logs/pipeline.log")
+STATE_PATH = Path("cache/pipeline.json")
+
+# I passi del README: cache_builder gira prima di find_missing e dopo copy_missing
+DEFAULT_STAGES = ["extract_media", "cache_builder", "find_missing", "copy_missing", "cache_builder",
+                  "remove_duplicates", "organise"]
+
+# Pacchetti senza i quali una fase viene saltata
+REQUIREMENTS = {
+    "near_duplicates": ("PIL",),
+    "organise": ("torch", "clip", "face_recognition"),
+}
+
+def setup_logger():
+    LOG_FILE.parent.mkdir(exist_ok=True, parents=True)
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[
+            logging.FileHandler(LOG_FILE, encoding='utf-8'),
+            logging.StreamHandler()
+        ]
+    )
+
+def load_config():
+    with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def stale_index(question: str) -> bool:
+    # Nessuna domanda a metà pipeline: la fase fallisce e non viene segnata come fatta
+    raise RuntimeError("cache dell'output non aggiornata, eseguire prima cache_builder")
+
+# Ogni fase importa il suo modulo solo quando parte: torch e CLIP arrivano con organise
+def run_extract_media(cfg: dict, mode: str):
+    from extract_media import scan_and_copy
+    scan_and_copy(cfg)
+
+def run_cache_builder(cfg: dict, mode: str):
+    from cache_builder import update_cache
+    update_cache(cfg)
+
+def run_find_missing(cfg: dict, mode: str):
+    from find_missing import find_all_missing
+    find_all_missing(cfg, mode, confirm=stale_index)
+
+def run_copy_missing(cfg: dict, mode: str):
+    from copy_missing import copy_missing
+    copy_missing(cfg)
+
+def run_remove_duplicates(cfg: dict, mode: str):
+    from remove_duplicates import remove_duplicates
+    remove_duplicates(cfg)
+
+def run_near_duplicates(cfg: dict, mode: str):
+    from near_duplicates import find_near_duplicates
+    find_near_duplicates(cfg)
+
+def run_organise(cfg: dict, mode: str):
+    from organise import main
+    main(cfg)
+
+STAGES = {
+    "extract_media": run_extract_media,
+    "cache_builder": run_cache_builder,
+    "find_missing": run_find_missing,
+    "copy_missing": run_copy_missing,
+    "remove_duplicates": run_remove_duplicates,
+    "near_duplicates": run_near_duplicates,
+    "organise": run_organise,
+}
+
+def stage_inputs(stage: str, cfg: dict) -> dict:
+    """Cosa legge una fase: alberi di cartelle, cartelle (senza sottocartelle), file e sezioni di config.json."""
+    outputs = [cfg["output"]["foto"], cfg["output"]["video"]]
+    if stage == "extract_media":
+        return {"trees": [cfg["sources"]["initial"]], "config": ["sources", "output", "media", "copy", "hashing"]}
+    if stage == "cache_builder":
+        return {"trees": outputs, "config": ["output", "media", "hashing", "fingerprint", "cache"]}
+    if stage == "find_missing":
+        sources = cfg["sources"].get("altre_foto", []) + cfg["sources"].get("altro_video", [])
+        return {"trees": sources + outputs, "files": list(cfg["missing_lists"].values()),
+                "config": ["sources", "output", "missing_lists", "media", "hashing", "fingerprint"]}
+    if stage == "copy_missing":
+        return {"files": list(cfg["missing_lists"].values()), "config": ["output", "missing_lists", "copy", "hashing"]}
+    if stage in ("remove_duplicates", "near_duplicates"):
+        return {"trees": [cfg["output"]["foto"]], "config": ["output", "media", "dedup", "hashing", "fingerprint"]}
+    if stage == "organise":
+        # organise legge solo i file in cima a output.foto
+        return {"folders": [cfg["output"]["foto"]], "trees": [os.path.join("output", "organizzate")],
+                "config": ["output", "media", "organise", "copy", "hashing"]}
+    return {}
+
+def tree_state(path) -> str:
+    """Impronta dell'albero: mtime di ogni cartella, senza leggere o fare stat dei file.
+
+    Aggiungere, togliere o rinominare un file cambia l'mtime della sua cartella;
+    un file riscritto sul posto no (come per cache_builder senza full_scan).
+    """
+    try:
+        states = [("", os.stat(path).st_mtime_ns)]
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    stack = [(str(path), "")]
+    while stack:
+        folder, rel_dir = stack.pop()
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        sub = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                        states.append((sub, entry.stat(follow_symlinks=False).st_mtime_ns))
+                        stack.append((entry.path, sub))
+        except OSError as e:
+            logging.warning(f"Impossibile leggere {folder}: {e}")
+    return hashlib.sha256(json.dumps(sorted(states)).encode()).hexdigest()
+
+def folder_state(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def file_state(path) -> str:
+    # Contenuto e non mtime: un elenco riscritto uguale non fa ripartire chi lo legge
+    try:
+        return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+def missing_requirements(stage: str) -> list:
+    return [name for name in REQUIREMENTS.get(stage, ()) if importlib.util.find_spec(name) is None]
+
+class Pipeline:
+    """Esegue una sequenza di fasi in un solo processo, con la stessa configurazione.
+
+    Prima di ogni fase si calcola l'impronta dei suoi input (stage_inputs); se è
+    quella salvata dopo l'ultima esecuzione riuscita la fase viene saltata. Le
+    impronte degli alberi si calcolano una volta sola finché una fase non gira.
+    """
+
+    def __init__(self, cfg: dict, state_path=STATE_PATH, force: bool = False, mode: str = "hash"):
+        self.cfg = cfg
+        self.force = force
+        self.mode = mode
+        self.state_path = Path(state_path)
+        self.state = json.loads(self.state_path.read_text(encoding="utf-8")) if self.state_path.exists() else {}
+        self.trees = {}  # percorso -> tree_state, valide fino alla prossima fase eseguita
+
+    def tree(self, path) -> str:
+        if path not in self.trees:
+            self.trees[path] = tree_state(path)
+        return self.trees[path]
+
+    def signature(self, stage: str) -> str:
+        inputs = stage_inputs(stage, self.cfg)
+        data = {
+            "trees": {str(p): self.tree(p) for p in inputs.get("trees", [])},
+            "folders": {str(p): folder_state(p) for p in inputs.get("folders", [])},
+            "files": {str(p): file_state(p) for p in inputs.get("files", [])},
+            "config": {key: self.cfg.get(key) for key in inputs.get("config", [])},
+        }
+        if stage == "find_missing":
+            data["mode"] = self.mode
+        return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+    def save_state(self):
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.state_path.with_name(self.state_path.name + ".tmp")
+        tmp.write_text(json.dumps(self.state, indent=2), encoding="utf-8")
+        os.replace(tmp, self.state_path)
+
+    def run(self, stages) -> bool:
+        """Esegue ``stages`` in ordine; si ferma alla prima fase che fallisce."""
+        start = time.perf_counter()
+        for stage in stages:
+            missing = missing_requirements(stage)
+            if missing:
+                logging.warning(f"⏭️  {stage} saltata: mancano {', '.join(missing)}")
+                continue
+            if not self.force and self.state.get(stage) == self.signature(stage):
+                logging.info(f"⏭️  {stage}: input invariati, saltata")
+                metrics.inc("stages_skipped")
+                continue
+            logging.info(f"▶️  {stage}")
+            stage_start = time.perf_counter()
+            try:
+                STAGES[stage](self.cfg, self.mode)
+            except Exception as e:
+                logging.exception(f"❌ {stage} fallita: {e}")
+                return False
+            finally:
+                # La fase può aver scritto ovunque: le impronte vanno ricalcolate
+                self.trees.clear()
+            seconds = time.perf_counter() - stage_start
+            metrics.add_time(f"stage_{stage}", seconds)
+            metrics.inc("stages_run")
+            logging.info(f"✅ {stage} in {seconds:.1f}s")
+            # Impronta a fine fase: comprende quello che la fase stessa ha scritto
+            self.state[stage] = self.signature(stage)
+            self.save_state()
+        logging.info(f"🏁 Pipeline completata in {time.perf_counter() - start:.1f}s")
+        return True
+
+def main():
+    parser = argparse.ArgumentParser(description="Esegue le fasi del progetto in un solo processo.")
+    parser.add_argument("fasi", nargs="*",
+                        help=f"fasi da eseguire in ordine (default: pipeline.stages); valide: {', '.join(STAGES)}")
+    parser.add_argument("--forza", action="store_true", help="esegue le fasi anche se i loro input non sono cambiati")
+    parser.add_argument("--modo", choices=("name", "hash"),
+                        help="confronto di find_missing (default: pipeline.find_missing_mode)")
+    args = parser.parse_args()
+    unknown = [stage for stage in args.fasi if stage not in STAGES]
+    if unknown:
+        parser.error(f"fasi sconosciute: {', '.join(unknown)} (valide: {', '.join(STAGES)})")
+
+    setup_logger()
+    cfg = load_config()
+    pipeline_cfg = cfg.get("pipeline", {})
+    stages = args.fasi or pipeline_cfg.get("stages", DEFAULT_STAGES)
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        raise ValueError(f"Fasi sconosciute in pipeline.stages: {', '.join(unknown)} (valide: {', '.join(STAGES)})")
+    metrics.start_run("pipeline", cfg)
+    pipeline = Pipeline(cfg, pipeline_cfg.get("state") or STATE_PATH, args.forza,
+                        args.modo or pipeline_cfg.get("find_missing_mode", "hash"))
+    if not pipeline.run(stages):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import os
+import errno
+import shutil
+import logging
+from pathlib import Path
+from hashing import copy_and_hash, hash_file
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# ioctl FICLONE (linux/fs.h): clona i blocchi su btrfs/XFS senza copiarli
+FICLONE = 0x40049409
+
+PLACEMENT_MODES = ("reflink", "hardlink", "copy_file_range", "copy")
+
+# Se un modo non è supportato dal filesystem si prova il successivo.
+# hardlink non è un fallback del reflink: il file condividerebbe l'inode con la sorgente.
+FALLBACKS = {
+    "reflink": ("reflink", "copy_file_range", "copy"),
+    "hardlink": ("hardlink", "copy"),
+    "copy_file_range": ("copy_file_range", "copy"),
+    "copy": ("copy",),
+}
+
+# Errori con cui il filesystem rifiuta un modo: solo questi fanno passare al successivo.
+# OSError senza errno è il "non disponibile su questa piattaforma" sollevato qui.
+UNSUPPORTED_ERRNOS = {None, errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOSYS,
+                      errno.EINVAL, errno.EMLINK}
+
+_warned = set()
+
+def reflink(src: Path, dest: Path):
+    if fcntl is None:
+        raise OSError("reflink non disponibile su questa piattaforma")
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, dest)
+
+def hardlink(src: Path, dest: Path):
+    """Hardlink di ``src`` in ``dest``; un ``dest`` esistente viene sostituito con os.replace."""
+    if not os.path.lexists(dest):
+        os.link(src, dest)
+        return
+    tmp = Path(dest).with_name(f".{Path(dest).name}.{os.getpid()}.link")
+    os.link(src, tmp)
+    try:
+        os.replace(tmp, dest)
+    except OSError:
+        tmp.unlink()
+        raise
+
+def kernel_copy(src: Path, dest: Path):
+    """Copia nel kernel con copy_file_range (o sendfile), senza passare dallo spazio utente."""
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        offset = 0
+        while remaining > 0:
+            if hasattr(os, "copy_file_range"):
+                sent = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+            elif hasattr(os, "sendfile"):
+                sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, remaining)
+            else:
+                raise OSError("copy_file_range/sendfile non disponibili")
+            if sent == 0:
+                break
+            offset += sent
+            remaining -= sent
+    shutil.copystat(src, dest)
+
+def place_file(src: Path, dest: Path, mode: str = "copy", hash_algo: str = None):
+    """Porta ``src`` in ``dest`` con il modo richiesto, ripiegando sui modi più lenti.
+
+    Se ``hash_algo`` è indicato restituisce l'hash del contenuto: con la copia normale
+    viene calcolato nello stesso passaggio, negli altri casi rileggendo ``dest``.
+    """
+    if mode not in FALLBACKS:
+        raise ValueError(f"Modo di copia non supportato: {mode} (validi: {', '.join(PLACEMENT_MODES)})")
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        # Già al suo posto: hardlink di un'esecuzione precedente
+        return hash_file(dest, hash_algo) if hash_algo else None
+    for attempt in FALLBACKS[mode]:
+        if attempt == "copy":
+            if hash_algo:
+                return copy_and_hash(src, dest, hash_algo)
+            shutil.copy2(src, dest)
+            return None
+        try:
+            if attempt == "reflink":
+                reflink(src, dest)
+            elif attempt == "hardlink":
+                hardlink(src, dest)
+            else:
+                kernel_copy(src, dest)
+        except OSError as e:
+            # Un hardlink fallito non crea dest; negli altri casi va tolta la copia parziale
+            if attempt != "hardlink" and Path(dest).exists():
+                Path(dest).unlink()
+            if e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+            if (mode, attempt) not in _warned:
+                _warned.add((mode, attempt))
+                logging.warning(f"Modo '{attempt}' non supportato per {dest} ({e}), uso il successivo")
+            continue
+        return hash_file(dest, hash_algo) if hash_algo else None
@@ -3,9 +3,14 @@ import logging
 from pathlib import Path
 from collections import defaultdict
 from tqdm import tqdm
+import metrics
+from file_index import FileIndex
+from hash_index import open_index, dir_key, load_media, save_files, save_full_hash
+from cache_builder import compute_hash, compute_fingerprint
+from hashing import DEFAULT_ALGORITHM, new_hasher, configure_io, configured_algorithm, configured_fingerprint, fingerprint_prefix
 
 # Percorsi
-CACHE_ROOT = Path("cache/foto")
+CONFIG_PATH = "config.json"
 OUTPUT_ROOT = Path("output/foto")
 REPORT_PATH = Path("logs/duplicati_rimossi.txt")
 
@@ -20,36 +25,179 @@ def setup_logger():
         handlers=[logging.FileHandler(log_file, encoding='utf-8'), logging.StreamHandler()]
     )
 
-def load_hashes_from_cache(cache_root: Path) -> dict:
-    """Carica tutti gli hash da tutte le cache.json."""
+def load_config():
+    with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+@metrics.timed("compute_partial_hash")
+def compute_partial_hash(file_path: Path, size: int, block: int, algo: str = DEFAULT_ALGORITHM) -> str:
+    """Hash dei primi e degli ultimi ``block`` byte del file."""
+    h = new_hasher(algo)
+    with open(file_path, "rb") as f:
+        h.update(f.read(block))
+        if size > block:
+            f.seek(max(block, size - block))
+            h.update(f.read(block))
+    return h.hexdigest()
+
+def group_by(items, key):
+    groups = defaultdict(list)
+    for item in items:
+        groups[key(item)].append(item)
+    return [group for group in groups.values() if len(group) > 1]
+
+def load_hashes_tiered(conn, valid_exts: set, partial_bytes: int, media: str = "foto",
+                       algo: str = DEFAULT_ALGORITHM, fingerprint=None) -> dict:
+    """Trova i duplicati per livelli: dimensione → hash parziale → hash completo.
+
+    Legge per intero solo i file che collidono anche sull'hash parziale e salva
+    nell'indice gli hash calcolati, così le esecuzioni successive non rileggono nulla.
+    Con ``fingerprint`` i file grandi usano l'impronta a campioni al posto
+    dell'hash parziale.
+    """
+    cached = load_media(conn, media)
+    files = []
+    for f in sorted(metrics.timed_iter(OUTPUT_ROOT.rglob("*"))):
+        if f.suffix.lower() in valid_exts and f.is_file():
+            stat = f.stat()
+            entry = cached.get((dir_key(f.parent.relative_to(OUTPUT_ROOT)), f.name)) or {}
+            if entry.get("mtime") != stat.st_mtime or entry.get("algo") != algo:
+                entry = {}
+                metrics.inc("cache_misses")
+            else:
+                metrics.inc("cache_hits")
+            files.append({
+                "path": f,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "partial": entry.get("partial"),
+                "hash": entry.get("hash"),
+                "algo": algo,
+                "phash": entry.get("phash"),
+                "fingerprint": entry.get("fingerprint"),
+            })
+
+    bytes_read = 0
+    updated = []
+    size_groups = group_by(files, lambda e: e["size"])
+    candidates = [e for group in size_groups for e in group]
+    for e in tqdm(candidates, desc="Hash parziali", unit="file"):
+        if fingerprint and e["size"] >= fingerprint["min_size"]:
+            if not (e["fingerprint"] or "").startswith(fingerprint_prefix(fingerprint)):
+                e["fingerprint"] = compute_fingerprint(e["path"], algo, fingerprint["samples"],
+                                                       fingerprint["sample_bytes"])
+                if e["fingerprint"] is None:
+                    continue
+                bytes_read += min(e["size"], fingerprint["samples"] * fingerprint["sample_bytes"])
+                updated.append(e)
+            e["partial_key"] = e["fingerprint"]
+            continue
+        if e["partial"] is None:
+            try:
+                e["partial"] = compute_partial_hash(e["path"], e["size"], partial_bytes, algo)
+            except Exception as ex:
+                logging.warning(f"Errore hashing {e['path']}: {ex}")
+                continue
+            bytes_read += min(e["size"], 2 * partial_bytes)
+            updated.append(e)
+        e["partial_key"] = e["partial"]
+
+    partial_groups = group_by(
+        [e for e in candidates if e.get("partial_key")], lambda e: (e["size"], e["partial_key"])
+    )
+    candidates = [e for group in partial_groups for e in group]
+    for e in tqdm(candidates, desc="Hash completi", unit="file"):
+        if e["hash"] is None:
+            e["hash"] = compute_hash(e["path"], algo)
+            if e["hash"]:
+                bytes_read += e["size"]
+                updated.append(e)
+
+    # Riporta nell'indice gli hash calcolati
+    by_dir = defaultdict(dict)
+    for e in updated:
+        by_dir[dir_key(e["path"].parent.relative_to(OUTPUT_ROOT))][e["path"].name] = e
+    for rel_dir, entries in by_dir.items():
+        save_files(conn, media, rel_dir, entries)
+    conn.commit()
+
+    hash_map = defaultdict(list)
+    for e in candidates:
+        if e["hash"]:
+            hash_map[e["hash"]].append(e["path"])
+
+    logging.info(f"Totale file analizzati: {len(files)}")
+    logging.info(f"Gruppi con stessa dimensione: {len(size_groups)}")
+    logging.info(f"Gruppi con stesso hash parziale: {len(partial_groups)}")
+    metrics.inc("dedup_bytes_read", bytes_read)
+    logging.info(f"Byte letti: {bytes_read / 1024 ** 2:.1f} MB")
+    return hash_map
+
+def confirm_fingerprint_groups(conn, media: str = "foto", algo: str = DEFAULT_ALGORITHM) -> int:
+    """Calcola l'hash completo dei file con impronta veloce condivisa e hash mancante.
+
+    I file con impronta unica sono sicuramente diversi da tutti gli altri e
+    restano senza hash completo. Restituisce quanti hash sono stati calcolati.
+    """
+    rows = conn.execute(
+        """SELECT dir, name FROM files
+           WHERE media = ? AND algo = ? AND hash IS NULL AND fingerprint IN (
+               SELECT fingerprint FROM files WHERE media = ? AND fingerprint IS NOT NULL AND algo = ?
+               GROUP BY fingerprint HAVING COUNT(*) > 1)
+           ORDER BY dir, name""",
+        (media, algo, media, algo),
+    ).fetchall()
+    computed = 0
+    for rel_dir, fname in tqdm(rows, desc="Conferma impronte", unit="file"):
+        h = compute_hash(OUTPUT_ROOT / rel_dir / fname, algo)
+        if h:
+            save_full_hash(conn, media, rel_dir, fname, h)
+            computed += 1
+    conn.commit()
+    return computed
+
+def load_hashes_from_cache(conn, media: str = "foto", algo: str = DEFAULT_ALGORITHM) -> dict:
+    """Carica dall'indice gli hash presenti in più di un file.
+
+    Gli hash stanno in un FileIndex (digest binari in colonne): solo i gruppi
+    di duplicati diventano Path.
+    """
+    confirmed = confirm_fingerprint_groups(conn, media, algo)
+    if confirmed:
+        logging.info(f"Hash completi calcolati per confermare impronte uguali: {confirmed}")
     hash_map = defaultdict(list)
-    total_files = 0
     total_valid = 0
 
-    cache_files = list(cache_root.rglob("cache.json"))
-    for cache_file in cache_files:
-        try:
-            data = json.loads(cache_file.read_text(encoding="utf-8"))
-            base_dir = cache_file.parent.relative_to(cache_root)
-            for fname, info in data.get("files", {}).items():
-                h = info.get("hash")
-                if not h:
-                    continue
-                file_path = OUTPUT_ROOT / base_dir / fname
-                if file_path.exists():
-                    hash_map[h].append(file_path)
-                    total_valid += 1
-                total_files += 1
-        except Exception as e:
-            logging.warning(f"Errore lettura {cache_file}: {e}")
-
-    logging.info(f"Totale file in cache: {total_files}")
-    logging.info(f"File validi per l'analisi: {total_valid}")
-    logging.info(f"Hash unici: {len(hash_map)}")
+    index = FileIndex.from_index(conn, OUTPUT_ROOT, media, algo)
+    unique_hashes = 0
+    for rows in index.hash_groups():
+        unique_hashes += 1
+        if len(rows) < 2:
+            continue
+        for record in map(index.record, rows):
+            file_path = record.path
+            if file_path.exists():
+                hash_map[record.hash].append(file_path)
+                total_valid += 1
+
+    logging.info(f"Totale file in cache: {len(index)}")
+    logging.info(f"File candidati duplicati: {total_valid}")
+    logging.info(f"Hash unici: {unique_hashes}")
     return hash_map
 
-def remove_duplicates():
-    hash_map = load_hashes_from_cache(CACHE_ROOT)
+def remove_duplicates(cfg: dict = None):
+    cfg = cfg or load_config()
+    dedup_cfg = cfg.get("dedup", {})
+    algo = configured_algorithm(cfg)
+    configure_io(cfg)
+    conn = open_index()
+    if dedup_cfg.get("mode", "cache") == "tiered":
+        valid_exts = set(e.lower() for e in cfg["media"]["photo_extensions"])
+        hash_map = load_hashes_tiered(conn, valid_exts, dedup_cfg.get("partial_bytes", 4096), algo=algo,
+                                      fingerprint=configured_fingerprint(cfg))
+    else:
+        hash_map = load_hashes_from_cache(conn, algo=algo)
+    conn.close()
     duplicate_log = []
 
     total_duplicates = 0
@@ -81,6 +229,7 @@ def remove_duplicates():
         f.write(f"🔍 Hash con duplicati: {total_hashes_with_duplicates}\n")
         f.write(f"======================================================\n")
 
+    metrics.inc("duplicates_removed", total_duplicates)
     logging.info(f"🔁 Duplicati rimossi: {total_duplicates}")
     logging.info(f"🔍 Hash con duplicati: {total_hashes_with_duplicates}")
     logging.info(f"📄 Report salvato in: {REPORT_PATH}")
@@ -89,4 +238,6 @@ def remove_duplicates():
 
 if __name__ == "__main__":
     setup_logger()
-    remove_duplicates()
+    cfg = load_config()
+    metrics.start_run("remove_duplicates", cfg)
+    remove_duplicates(cfg)
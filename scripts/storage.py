@@ -0,0 +1,54 @@
+import os
+from functools import lru_cache
+from pathlib import Path
+
+STORAGE_CLASSES = ("hdd", "ssd", "nvme")
+DEFAULT_CLASS = "ssd"
+
+# Impostati da configure_storage: classe di ripiego e classi forzate per percorso
+_default_class = DEFAULT_CLASS
+_path_classes = []
+
+def configure_storage(cfg: dict):
+    """Legge la sezione ``storage`` di config.json.
+
+    ``paths`` forza la classe per i percorsi sotto un prefisso (utile per dischi
+    USB, RAID o LVM che sysfs non descrive); ``default`` vale quando non si sa.
+    """
+    global _default_class, _path_classes
+    storage_cfg = cfg.get("storage", {})
+    _default_class = storage_cfg.get("default", DEFAULT_CLASS)
+    classes = {os.path.abspath(p): c for p, c in storage_cfg.get("paths", {}).items()}
+    for kind in [_default_class, *classes.values()]:
+        if kind not in STORAGE_CLASSES:
+            raise ValueError(f"Classe di storage non supportata: {kind} (valide: {', '.join(STORAGE_CLASSES)})")
+    # Il prefisso più lungo vince
+    _path_classes = sorted(classes.items(), key=lambda item: len(item[0]), reverse=True)
+    device_class.cache_clear()
+
+@lru_cache(maxsize=None)
+def device_class(st_dev: int) -> str:
+    """Classe del disco a blocchi ``st_dev`` letta da sysfs (solo Linux)."""
+    try:
+        block = Path(f"/sys/dev/block/{os.major(st_dev)}:{os.minor(st_dev)}").resolve(strict=True)
+    except (OSError, AttributeError):
+        return _default_class
+    # Per una partizione la coda è quella del disco che la contiene
+    for candidate in (block, block.parent):
+        rotational = candidate / "queue" / "rotational"
+        if rotational.exists():
+            if candidate.name.startswith("nvme"):
+                return "nvme"
+            return "hdd" if rotational.read_text().strip() == "1" else "ssd"
+    return _default_class
+
+def storage_class(path, st_dev: int = None) -> str:
+    """'hdd', 'ssd' o 'nvme' per il disco che contiene ``path``."""
+    if _path_classes:
+        absolute = os.path.abspath(path)
+        for prefix, kind in _path_classes:
+            if absolute == prefix or absolute.startswith(prefix.rstrip(os.sep) + os.sep):
+                return kind
+    if st_dev is None:
+        st_dev = os.stat(path).st_dev
+    return device_class(st_dev)
@@ -1,9 +1,10 @@
-import json
 from pathlib import Path
+from hash_index import open_index, get_folder_mtime
 
 # Carica la cache
-cache = json.load(open("hash_index_output.json", "r", encoding="utf-8"))
-cached = cache.get("__meta__", {}).get("folder_mtime", None)
+conn = open_index()
+cached = get_folder_mtime(conn, "video")
+conn.close()
 print("mtime salvato in cache:   ", cached)
 
 # Prendi il mtime reale della directory
@@ -13,4 +14,4 @@ print("mtime reale della dir:    ", actual)
 if cached == actual:
     print("✅ OK: i due valori coincidono")
 else:
-    print("⚠️ Non coincidono: cache→dir ha cambiato qualcosa?")
\ No newline at end of file
+    print("⚠️ Non coincidono: cache→dir ha cambiato qualcosa?")
@@ -1,12 +1,13 @@
-import json
+import sqlite3
 from pathlib import Path
 
+INDEX_PATH = Path("cache/index.sqlite")
+
 def check_cache(media_type: str):
-    cache_file = Path(f"cache/{media_type}/cache.json")
     output_dir = Path(f"output/{media_type}")
 
-    if not cache_file.exists():
-        print(f"[{media_type}] ❌ Cache file not found: {cache_file}")
+    if not INDEX_PATH.exists():
+        print(f"[{media_type}] ❌ Cache index not found: {INDEX_PATH}")
         return
 
     if not output_dir.exists():
@@ -15,12 +16,15 @@ def check_cache(media_type: str):
 
     # Load cache
     try:
-        cache = json.loads(cache_file.read_text(encoding="utf-8"))
+        with sqlite3.connect(INDEX_PATH) as conn:
+            row = conn.execute(
+                "SELECT folder_mtime FROM folders WHERE media = ? AND dir = ''", (media_type,)
+            ).fetchone()
     except Exception as e:
         print(f"[{media_type}] ❌ Failed to read cache: {e}")
         return
 
-    cached_mtime = cache.get("__meta__", {}).get("folder_mtime", None)
+    cached_mtime = row[0] if row else None
     actual_mtime = output_dir.stat().st_mtime
 
     print(f"[{media_type}] Cached mtime: {cached_mtime}")